@@ -1,22 +1,29 @@
 """
 Analyzes contents of the JobBOSS database and produces a report tarball
 containing information to help with configuring the integration. The report
-will be located at /tmp/jobboss-report-<HOSTNAME>.tar.gz
+will be located at /tmp/jobboss-report-<HOSTNAME>.tar.gz; run with --help for
+other formats and locations.
+
+Each export streams rows from the database in chunks, joining related tables
+in the query, so memory use does not grow with table size. The independent
+exports run concurrently, each on its own database connection.
+
+Django and the JobBOSS models are imported after the arguments are parsed,
+so that --help answers at once.
 """
+import argparse
+from concurrent.futures import ThreadPoolExecutor
 import common
-import csv
-import os
 import socket
-common.configure()
-from django.db import connection
-from django.db.models import Count
-from django.utils.text import slugify
-import jobboss.models as jb
-from jobboss.export import export_table
+from report import CODECS, ReportPackage
+
+CHUNK_SIZE = 2000
+"""Rows fetched from the database at a time"""
 
 
 def get_database_names():
     """Return a list of database names on this SQL Server instance."""
+    from django.db import connection
     with connection.cursor() as cursor:
         cursor.execute(
             'SELECT name, database_id, create_date FROM sys.databases;')
@@ -29,6 +36,8 @@ def get_database_names():
 
 
 def get_sales_codes():
+    from django.db.models import Count
+    import jobboss.models as jb
     qs = jb.Job.objects.values('sales_code').annotate(
         count=Count('sales_code')).order_by('-count')
     return {
@@ -37,54 +46,117 @@ def get_sales_codes():
     }
 
 
-def export_customers():
-    export_table(jb.Customer, '/tmp/report/customers.csv')
+def export_rows(package, name, header, qs):
+    """Write header and the rows of values_list queryset qs to the CSV member
+    name of package, fetching CHUNK_SIZE rows at a time. Returns the row
+    count."""
+    with package.table(name, header) as table:
+        for row in qs.iterator(chunk_size=CHUNK_SIZE):
+            table.writerow(row)
+    return table.rows
+
+
+def export_customers(package):
+    import jobboss.models as jb
+    fields = [f.attname for f in jb.Customer._meta.concrete_fields]
+    return export_rows(package, 'customers.csv', fields,
+                       jb.Customer.objects.values_list(*fields))
+
+
+def export_ops(package):
+    import jobboss.models as jb
+    return export_rows(
+        package, 'wc_op.csv', ('Work Center', 'Operation'),
+        jb.Operation.objects.values_list('work_center__work_center',
+                                         'operation'))
+
+
+def export_work_centers(package):
+    import jobboss.models as jb
+    return export_rows(
+        package, 'wc.csv', ('Work Center',),
+        jb.WorkCenter.objects.values_list('work_center'))
 
 
-def export_ops():
-    with open('/tmp/report/wc_op.csv', 'w') as f:
-        w = csv.writer(f)
-        w.writerow(('Work Center', 'Operation'))
-        for operation in jb.Operation.objects.all():
-            w.writerow((operation.work_center.work_center, operation.operation))
-    with open('/tmp/report/wc.csv', 'w') as f:
-        w = csv.writer(f)
-        w.writerow(('Work Center',))
-        for wc in jb.WorkCenter.objects.all():
-            w.writerow((wc.work_center,))
-    with open('/tmp/report/vend_svc.csv', 'w') as f:
-        w = csv.writer(f)
-        w.writerow(('Vendor', 'Service', 'Description'))
-        for vs in jb.VendorService.objects.all():
-            w.writerow(
-                (vs.vendor.vendor, vs.service.service, vs.service.description)
-            )
+def export_vendor_services(package):
+    import jobboss.models as jb
+    return export_rows(
+        package, 'vend_svc.csv', ('Vendor', 'Service', 'Description'),
+        jb.VendorService.objects.values_list(
+            'vendor__vendor', 'service__service', 'service__description'))
+
+
+EXPORTS = (export_customers, export_ops, export_work_centers,
+           export_vendor_services)
+
+
+def run_concurrently(calls):
+    """Make each (function, *args) call in calls on its own thread and return
+    a dict of function name -> result, raising the first error."""
+    with ThreadPoolExecutor(max_workers=len(calls)) as executor:
+        futures = {
+            call[0].__name__: executor.submit(common.on_own_connection, *call)
+            for call in calls}
+        return {name: future.result() for name, future in futures.items()}
 
 
 def get_job_so_counts():
+    import jobboss.models as jb
     return {
         'jobs': jb.Job.objects.count(),
         'so_items': jb.SoDetail.objects.count()
     }
 
 
-if __name__ == '__main__':
-    os.system('mkdir /tmp/report')
-    with open('/tmp/report/report.txt', 'w') as f:
-        f.write('JobBOSS Analysis Report\n\n')
-        f.write('Available databases:\n')
-        for name in get_database_names():
-            f.write(name + '\n')
-        f.write('\n\nSales codes:\n')
-        for sales_code, count in get_sales_codes().items():
-            if sales_code is not None:
-                f.write('{} ({} jobs)\n'.format(sales_code, count))
-        f.write('\n\nSales orders:\n')
-        counts = get_job_so_counts()
-        f.write('Jobs: {}\n'.format(counts['jobs']))
-        f.write('Sales Order Items: {}\n\n'.format(counts['so_items']))
-    export_customers()
-    export_ops()
-    os.system('cd /tmp/report; tar czf ../jobboss-report-{}.tar.gz *'.format(
-        slugify(socket.gethostname())
+def write_summary(package, results):
+    lines = ['JobBOSS Analysis Report\n', 'Available databases:']
+    lines.extend(results['get_database_names'])
+    lines.extend(('', '', 'Sales codes:'))
+    for sales_code, count in results['get_sales_codes'].items():
+        if sales_code is not None:
+            lines.append('{} ({} jobs)'.format(sales_code, count))
+    counts = results['get_job_so_counts']
+    lines.extend((
+        '', '', 'Sales orders:',
+        'Jobs: {}'.format(counts['jobs']),
+        'Sales Order Items: {}'.format(counts['so_items']),
+        '', '', 'Exported tables:',
     ))
+    for name, s in package.stats.items():
+        lines.append('{}: {} rows, {} bytes'.format(name, s['rows'],
+                                                    s['bytes']))
+    package.add_text('report.txt', '\n'.join(lines) + '\n')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--codec', choices=CODECS, default='gz',
+                        help='gz, bz2 or xz for a tar archive, or zip.')
+    parser.add_argument('--level', type=int, default=6,
+                        help='Compression level, 1 (fastest) to 9 (smallest).')
+    parser.add_argument('--incremental', action='store_true',
+                        help='Write each table to its own compressed file in '
+                             'a folder as soon as it is exported, so that a '
+                             'partial report survives a failure.')
+    parser.add_argument('--output', default=None,
+                        help='Report path without extension; defaults to '
+                             '/tmp/jobboss-report-<HOSTNAME>.')
+    args = parser.parse_args()
+    common.configure()
+    from django.utils.text import slugify
+
+    path = args.output or '/tmp/jobboss-report-{}'.format(
+        slugify(socket.gethostname()))
+    with ReportPackage(path, args.codec, args.level,
+                       args.incremental) as package:
+        results = run_concurrently(
+            [(get_database_names,), (get_sales_codes,),
+             (get_job_so_counts,)] +
+            [(export, package) for export in EXPORTS])
+        write_summary(package, results)
+    for name, s in package.stats.items():
+        print('{:<16} {:>10} rows {:>14} bytes {:>14} compressed'.format(
+            name, s['rows'], s['bytes'],
+            s['compressed_bytes'] if s['compressed_bytes'] is not None
+            else '-'))
+    print('Report written to {} ({} bytes)'.format(package.path, package.size))
@@ -0,0 +1,47 @@
+"""
+Precomputed view of one order item's assembly tree, built in a single pass
+over iterate_assembly(), so that importing the item does not walk the tree
+again or search a parent's children for each hardware component.
+"""
+from paperless.objects.orders import OrderItem
+from jobboss.query.job import AssemblySuffixCounter
+
+
+class AssemblyIndex:
+    """manufactured: (assembly component, job suffix) for each manufactured
+    component and assembly, in iterate_assembly() order; the root's suffix
+    is ''.
+
+    hardware: (component, [(parent component ID, quantity per parent)]) for
+    each purchased component, in component order; the quantity is None if
+    the parent does not list the component as a child."""
+
+    def __init__(self, order_item: OrderItem):
+        self.manufactured = []
+        suffix = AssemblySuffixCounter()
+        for assm_comp in order_item.iterate_assembly():
+            comp = assm_comp.component
+            if comp.is_hardware:
+                continue
+            if comp.is_root_component:
+                suffix.get_suffix(0, 0, 1)
+                self.manufactured.append((assm_comp, ''))
+            else:
+                self.manufactured.append((assm_comp, suffix.get_suffix(
+                    assm_comp.level,
+                    assm_comp.level_index,
+                    assm_comp.level_count
+                )))
+
+        self.child_quantity = {}  # (parent ID, child ID) -> quantity
+        for comp in order_item.components:
+            for child in comp.children:
+                self.child_quantity.setdefault(
+                    (comp.id, child.child_id), child.quantity)
+
+        self.hardware = [
+            (comp, [(parent_id,
+                     self.child_quantity.get((parent_id, comp.id)))
+                    for parent_id in comp.parent_ids])
+            for comp in order_item.components if comp.is_hardware
+        ]
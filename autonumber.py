@@ -0,0 +1,104 @@
+"""
+Hands out JobBOSS AutoNumber values (sales order, job, attachment and
+delivery numbers) from blocks reserved up front, so that importing an order
+takes the lock on each AutoNumber row once instead of once per inserted row.
+"""
+from collections import deque
+from django.db import transaction
+from django.db.models import F, Max
+import common
+import jobboss.models as jb
+
+logger = common.get_logger('autonumber')
+
+AUTONUMBER_FIELDS = {
+    jb.SoHeader: ('SalesOrder', 'sales_order', int),
+    jb.Job: ('Job', 'job', str),
+    jb.Attachment: ('Attachment', 'attachment', int),
+    jb.Delivery: ('Delivery', 'delivery', int),
+}
+"""Model -> (AutoNumber type, key field, key type)"""
+
+
+def order_autonumber_counts(order):
+    """Return the number of keys of each type that importing order will use:
+    one sales order, two links on the sales order plus two per root job, and
+    one root job and delivery per order item."""
+    n = len(order.order_items)
+    return {
+        jb.SoHeader: 1,
+        jb.Attachment: 2 + 2 * n,
+        jb.Job: n,
+        jb.Delivery: n,
+    }
+
+
+class AutoNumberAllocator:
+    """With dry_run, numbers are handed out following the current AutoNumber
+    values without reserving them, so that an import can be planned without
+    writing to the database."""
+
+    def __init__(self, dry_run=False):
+        self.dry_run = dry_run
+        self._blocks = {}  # model -> deque of reserved numbers
+        self._last = {}  # model -> last number handed out in a dry run
+
+    def reserve(self, model, count):
+        """Reserve count consecutive numbers for model with a single update
+        of its AutoNumber row. Call this outside of any long-running
+        transaction so the row lock is released immediately."""
+        if count <= 0:
+            return
+        an_type, field, key_type = AUTONUMBER_FIELDS[model]
+        if self.dry_run:
+            self._reserve_dry_run(model, count)
+            return
+        with transaction.atomic():
+            qs = jb.AutoNumber.objects.filter(type=an_type)
+            if qs.update(last_nbr=F('last_nbr') + count):
+                last = qs.values_list('last_nbr', flat=True).get()
+            else:
+                last = count
+                if key_type is int:
+                    last += model.objects.aggregate(n=Max(field))['n'] or 0
+                jb.AutoNumber.objects.create(
+                    type=an_type,
+                    system_generated=True,
+                    last_nbr=last
+                )
+        logger.debug('Reserved %d %s numbers ending at %d', count, an_type,
+                     last)
+        self._blocks.setdefault(model, deque()).extend(
+            range(last - count + 1, last + 1))
+
+    def _reserve_dry_run(self, model, count):
+        an_type, field, key_type = AUTONUMBER_FIELDS[model]
+        last = self._last.get(model)
+        if last is None:
+            last = jb.AutoNumber.objects.filter(type=an_type).values_list(
+                'last_nbr', flat=True).first()
+        if last is None:
+            last = model.objects.aggregate(n=Max(field))['n'] or 0 \
+                if key_type is int else 0
+        self._last[model] = last + count
+        self._blocks.setdefault(model, deque()).extend(
+            range(last + 1, last + count + 1))
+
+    def reserve_for_order(self, order):
+        for model, count in order_autonumber_counts(order).items():
+            self.reserve(model, count)
+
+    def assign(self, instance):
+        """Set the key field of instance to the next reserved number,
+        reserving one more if the block is exhausted."""
+        model = type(instance)
+        _, field, key_type = AUTONUMBER_FIELDS[model]
+        if not self._blocks.get(model):
+            self.reserve(model, 1)
+        setattr(instance, field, key_type(self._blocks[model].popleft()))
+        return instance
+
+    @property
+    def unused(self):
+        return {model.__name__: len(block)
+                for model, block in self._blocks.items() if block}
@@ -0,0 +1,185 @@
+"""
+Local backlog of the orders received from Paperless Parts and not yet
+imported. Each order is stored, pickled, in a SQLite file as soon as the
+Paperless SDK hands it over, with its state: pending, in flight, done or
+failed. If the connector stops part way through a backlog, the next run
+resumes with the orders it already holds instead of fetching them again.
+An order whose import fails is retried after a delay that doubles with each
+attempt, and is marked failed after max_attempts.
+
+An order left in flight by a crash is returned to pending, unless JobBOSS
+already has a sales order for it that the ledger did not record, as happens
+if the connector stops between the JobBOSS commit and the ledger write or
+the ledger is kept in memory; such an order is marked done.
+"""
+import datetime
+import pickle
+import sqlite3
+import threading
+import time
+import common
+
+logger = common.get_logger('backlog')
+
+PENDING = 'pending'
+IN_FLIGHT = 'in_flight'
+DONE = 'done'
+FAILED = 'failed'
+
+
+class Backlog:
+    """Orders waiting to be imported, stored in a SQLite file if a path is
+    given or in memory otherwise."""
+
+    def __init__(self, path=None, max_attempts=5, backoff=60,
+                 max_backoff=3600):
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self._db = sqlite3.connect(path or ':memory:',
+                                   check_same_thread=False)
+        self._lock = threading.Lock()
+        if path:
+            self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS orders ('
+            'order_number INTEGER PRIMARY KEY, state TEXT, data BLOB, '
+            'attempts INTEGER, next_attempt REAL, last_error TEXT, '
+            'updated_at TEXT)')
+        self._db.execute('CREATE INDEX IF NOT EXISTS orders_due '
+                         'ON orders (state, next_attempt)')
+        self._db.commit()
+
+    def _execute(self, sql, params=()):
+        with self._lock:
+            cursor = self._db.execute(sql, params)
+            self._db.commit()
+            return cursor
+
+    @staticmethod
+    def _now():
+        return datetime.datetime.now().isoformat(timespec='seconds')
+
+    def add(self, order):
+        """Hold order as pending. If the order is already held and still
+        pending, only its stored copy is replaced; orders in flight, done or
+        failed are left as they are."""
+        self._execute(
+            'INSERT INTO orders VALUES (?, ?, ?, 0, ?, NULL, ?) '
+            'ON CONFLICT (order_number) DO UPDATE SET data = excluded.data, '
+            'updated_at = excluded.updated_at WHERE state = ?',
+            (order.number, PENDING, pickle.dumps(order), time.time(),
+             self._now(), PENDING))
+
+    def take(self, limit):
+        """Mark up to limit pending orders that are due in flight and return
+        them, oldest first."""
+        with self._lock:
+            rows = self._db.execute(
+                'SELECT order_number, data FROM orders '
+                'WHERE state = ? AND next_attempt <= ? '
+                'ORDER BY next_attempt, order_number LIMIT ?',
+                (PENDING, time.time(), limit)).fetchall()
+            self._db.executemany(
+                'UPDATE orders SET state = ?, updated_at = ? '
+                'WHERE order_number = ?',
+                [(IN_FLIGHT, self._now(), number) for number, _ in rows])
+            self._db.commit()
+        return [pickle.loads(data) for _, data in rows]
+
+    def done(self, order_number):
+        self._execute(
+            'UPDATE orders SET state = ?, data = NULL, last_error = NULL, '
+            'updated_at = ? WHERE order_number = ?',
+            (DONE, self._now(), order_number))
+
+    def failed(self, order_number, error):
+        """Record a failed attempt to import order_number, scheduling a
+        retry or, after max_attempts, marking it failed. Returns the new
+        state."""
+        with self._lock:
+            row = self._db.execute(
+                'SELECT attempts FROM orders WHERE order_number = ?',
+                (order_number,)).fetchone()
+            attempts = (row[0] if row else 0) + 1
+            delay = min(self.backoff * 2 ** (attempts - 1), self.max_backoff)
+            state = FAILED if attempts >= self.max_attempts else PENDING
+            self._db.execute(
+                'UPDATE orders SET state = ?, attempts = ?, next_attempt = ?, '
+                'last_error = ?, updated_at = ? WHERE order_number = ?',
+                (state, attempts, time.time() + delay, str(error),
+                 self._now(), order_number))
+            self._db.commit()
+        if state == FAILED:
+            logger.error('Order %s failed %d times; giving up', order_number,
+                         attempts)
+        else:
+            logger.warning('Order %s failed (attempt %d); retrying in %ds',
+                           order_number, attempts, delay)
+        return state
+
+    def recover(self, imported=None):
+        """Return orders left in flight by a previous run to pending, or
+        mark them done if imported(order number), if given, returns the
+        sales order they were already imported as. Returns the number of
+        orders returned to pending."""
+        with self._lock:
+            numbers = [n for n, in self._db.execute(
+                'SELECT order_number FROM orders WHERE state = ?',
+                (IN_FLIGHT,))]
+        count = 0
+        for number in numbers:
+            sales_order = imported(number) if imported else None
+            if sales_order is not None:
+                logger.warning('Order %s was imported as sales order %s '
+                               'before the connector stopped; not importing '
+                               'it again', number, sales_order)
+                self.done(number)
+                continue
+            self._execute(
+                'UPDATE orders SET state = ?, next_attempt = ?, '
+                'updated_at = ? WHERE order_number = ?',
+                (PENDING, time.time(), self._now(), number))
+            count += 1
+        if count:
+            logger.info('Resuming %d orders interrupted in a previous run',
+                        count)
+        return count
+
+    def retry_failed(self):
+        """Give orders marked failed another max_attempts attempts."""
+        return self._execute(
+            'UPDATE orders SET state = ?, attempts = 0, next_attempt = ?, '
+            'updated_at = ? WHERE state = ?',
+            (PENDING, time.time(), self._now(), FAILED)).rowcount
+
+    def counts(self):
+        """Return {state: number of orders}."""
+        with self._lock:
+            return dict(self._db.execute(
+                'SELECT state, COUNT(*) FROM orders GROUP BY state'))
+
+
+BACKLOG = None
+
+
+def get_backlog():
+    """Return the backlog, opening it and recovering orders left in flight
+    on first use."""
+    global BACKLOG
+    if BACKLOG is None:
+        config = common.PAPERLESS_CONFIG
+        BACKLOG = Backlog(config.backlog_path, config.retry_attempts,
+                          config.retry_backoff)
+        BACKLOG.recover(_imported_unrecorded)
+    return BACKLOG
+
+
+def _imported_unrecorded(order_number):
+    """The sales order order_number was imported as, if the ledger has no
+    record of it."""
+    from job import imported_sales_order
+    from ledger import get_ledger
+    if get_ledger().get(order_number) is not None:
+        return None  # process_order decides from the ledger entry
+    return imported_sales_order(order_number)
@@ -0,0 +1,63 @@
+"""
+Compares the results of benchmark.py and startup_benchmark.py against a
+baseline kept in a JSON file. Results map a name, such as an import phase or
+a command line mode, to a dict with the seconds it took and any counts that
+must not grow.
+"""
+import json
+import os
+import sys
+
+
+def add_arguments(parser, path, per):
+    """Add the --baseline, --save-baseline, --tolerance and --json options to
+    parser; per names what the tolerance applies to, e.g. 'phase'."""
+    parser.add_argument('--baseline', default=path)
+    parser.add_argument('--save-baseline', action='store_true')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='Allowed fractional slowdown per {}.'.format(per))
+    parser.add_argument('--json', default=None,
+                        help='Also write the results to this file.')
+
+
+def compare(results, baseline, tolerance, counts=()):
+    """Return a list of regressions of results against baseline."""
+    problems = []
+    for name, base in baseline.items():
+        r = results.get(name)
+        if r is None:
+            continue
+        for metric in counts:
+            if r[metric] > base[metric]:
+                problems.append('{} {}: {} > {}'.format(
+                    name, metric, r[metric], base[metric]))
+        if r['seconds'] > base['seconds'] * (1 + tolerance) + 0.01:
+            problems.append('{} seconds: {:.4f} > {:.4f}'.format(
+                name, r['seconds'], base['seconds']))
+    return problems
+
+
+def check(args, scenario, results, counts=()):
+    """Write results to args.json if given. Then, with --save-baseline, record
+    them as the baseline of scenario; otherwise compare them against it and
+    exit with status 1 on a regression."""
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({scenario: results}, f, indent=2)
+    baselines = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baselines = json.load(f)
+    if args.save_baseline:
+        baselines.setdefault(scenario, {}).update(results)
+        with open(args.baseline, 'w') as f:
+            json.dump(baselines, f, indent=2)
+        print('Saved baseline to', args.baseline)
+    elif scenario in baselines:
+        problems = compare(results, baselines[scenario], args.tolerance,
+                           counts)
+        for problem in problems:
+            print('REGRESSION', problem)
+        if problems:
+            sys.exit(1)
+        print('No regressions against', args.baseline)
@@ -0,0 +1,215 @@
+"""
+Measures process_order against synthetic orders of configurable size, using
+the same test database as test.py. For each phase of the import it reports
+wall time, number of SQL statements, rows written and peak Python memory.
+
+To run a benchmark:
+
+1. activate virtual environment; for example:
+    source osenv/bin/activate
+
+2. run this module as a script, for example:
+    python benchmark.py --items 10 --depth 3 --fanout 2 --ops 15 --hardware 5
+
+Pass --save-baseline to record the results, and later runs will be compared
+against them. The run exits with status 1 if the number of queries or rows
+written grew, or a phase got slower than --tolerance allows.
+"""
+import sys
+import os
+sys.path.append('jobboss-python')
+sys.path.append('core-python')
+os.environ.setdefault(
+    'DJANGO_SETTINGS_MODULE',
+    'jobboss.settings'
+)
+import argparse
+import copy
+import itertools
+import json
+import time
+import tracemalloc
+from unittest.mock import MagicMock
+import baselines
+import common
+from paperless.client import PaperlessClient
+from paperless.objects.orders import Order
+common.configure(test_mode=True)
+from instrument import QueryRecorder
+from timing import PhaseTimer
+
+TEMPLATE_PATH = 'core-python/tests/unit/mock_data/order.json'
+BASELINE_PATH = 'benchmark_baseline.json'
+
+
+class BenchmarkTimer(PhaseTimer):
+    """PhaseTimer that also records each phase's peak traced memory, and the
+    SQL statements and rows written in each phase via a QueryRecorder."""
+
+    def __init__(self):
+        super().__init__()
+        self.recorder = QueryRecorder(self)
+        self.peak_memory = {}
+
+    def switch(self, name):
+        if self._current is not None:
+            peak = tracemalloc.get_traced_memory()[1]
+            self.peak_memory[self._current] = max(
+                self.peak_memory.get(self._current, 0), peak)
+        tracemalloc.reset_peak()
+        super().switch(name)
+
+    def results(self):
+        queries = self.recorder.phases
+        phases = list(self.durations) + \
+            [p for p in queries if p not in self.durations]
+        return {
+            phase: {
+                'seconds': round(self.durations.get(phase, 0.), 4),
+                'queries': queries.get(phase, {}).get('queries', 0),
+                'rows': queries.get(phase, {}).get('rows', 0),
+                'peak_kb': self.peak_memory.get(phase, 0) // 1024,
+            }
+            for phase in phases
+        }
+
+
+def generate_order(template, number, items=1, depth=1, fanout=2, ops=5,
+                   hardware=2):
+    """Return order JSON with items identical order items, each an assembly
+    tree depth levels deep where every assembly has fanout manufactured
+    children, every manufactured component has ops shop operations, and
+    the root has hardware purchased components. Components are cloned from
+    the template order."""
+    order = copy.deepcopy(template)
+    order['number'] = number
+    item_template = template['order_items'][0]
+    comps = item_template['components']
+    mfg_template = next(c for c in comps if c.get('is_root_component'))
+    hw_template = next((c for c in comps if c.get('type') == 'purchased'),
+                       mfg_template)
+    op_templates = [op for c in comps for op in c.get('shop_operations', [])]
+    ids = itertools.count(1)
+
+    def component(template, item_n, **kwargs):
+        comp = copy.deepcopy(template)
+        comp_id = next(ids)
+        comp.update(
+            id=comp_id,
+            part_number='BENCH-{}-{}-{}'.format(number, item_n, comp_id),
+            child_ids=[],
+            children=[],
+            parent_ids=[],
+            is_root_component=False,
+            innate_quantity=1,
+        )
+        comp.update(kwargs)
+        return comp
+
+    def build(item_n, level, parent, out):
+        comp = component(mfg_template, item_n, type='manufactured')
+        comp['shop_operations'] = [
+            dict(copy.deepcopy(op_templates[k % len(op_templates)]),
+                 id=next(ids))
+            for k in range(ops if op_templates else 0)
+        ]
+        if parent is None:
+            comp['is_root_component'] = True
+        else:
+            comp['parent_ids'] = [parent['id']]
+            parent['child_ids'].append(comp['id'])
+            parent['children'].append({'child_id': comp['id'], 'quantity': 1})
+            parent['type'] = 'assembled'
+        out.append(comp)
+        if level < depth:
+            for _ in range(fanout):
+                build(item_n, level + 1, comp, out)
+        return comp
+
+    order['order_items'] = []
+    for item_n in range(items):
+        item = copy.deepcopy(item_template)
+        item['id'] = next(ids)
+        out = []
+        root = build(item_n, 1, None, out)
+        for _ in range(hardware):
+            hw = component(hw_template, item_n, type='purchased',
+                           shop_operations=[], parent_ids=[root['id']])
+            root['child_ids'].append(hw['id'])
+            root['children'].append({'child_id': hw['id'], 'quantity': 1})
+            out.append(hw)
+        item['components'] = out
+        item['root_component_id'] = root['id']
+        order['order_items'].append(item)
+    return order
+
+
+def run(args):
+    import jobboss.models as jb
+    from django.db import connection
+    import ledger
+    from job import process_order, plan_order
+    ledger.LEDGER = ledger.Ledger()  # in memory, so every run imports
+    for an_type in ('SalesOrder', 'Job'):
+        jb.AutoNumber.objects.get_or_create(
+            type=an_type, defaults={'system_generated': True, 'last_nbr': 1})
+    with open(TEMPLATE_PATH) as data_file:
+        template = json.load(data_file)
+    client = PaperlessClient()
+    timers = []
+    tracemalloc.start()
+    for n in range(args.repeat):
+        client.get_resource = MagicMock(return_value=generate_order(
+            template, 1000 + n, args.items, args.depth, args.fanout,
+            args.ops, args.hardware))
+        order = Order.get(1000 + n)
+        timer = BenchmarkTimer()
+        start = time.perf_counter()
+        with connection.execute_wrapper(timer.recorder):
+            if args.plan_only:
+                plan_order(order, timer)
+            else:
+                process_order(order, timer)
+        timer.durations['total'] = time.perf_counter() - start
+        timers.append(timer)
+    tracemalloc.stop()
+    # keep the fastest run; after the first run caches are warm, as they
+    # are in a long-running connector
+    fastest = min(timers, key=lambda t: t.durations['total'])
+    for n1 in fastest.recorder.n_plus_one():
+        print('N+1: {} queries from {}'.format(n1['queries'], n1['site']))
+    return fastest.results()
+
+
+def print_results(results):
+    print('{:<12} {:>10} {:>8} {:>8} {:>10}'.format(
+        'phase', 'seconds', 'queries', 'rows', 'peak KB'))
+    for phase, r in results.items():
+        print('{:<12} {:>10.4f} {:>8} {:>8} {:>10}'.format(
+            phase, r['seconds'], r['queries'], r['rows'], r['peak_kb']))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--items', type=int, default=5)
+    parser.add_argument('--depth', type=int, default=2)
+    parser.add_argument('--fanout', type=int, default=2)
+    parser.add_argument('--ops', type=int, default=10)
+    parser.add_argument('--hardware', type=int, default=3)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--plan-only', action='store_true',
+                        help='Only plan the import, measuring the work of '
+                             'building rows apart from writing them.')
+    baselines.add_arguments(parser, BASELINE_PATH, 'phase')
+    args = parser.parse_args()
+
+    from django.test.utils import setup_databases
+    setup_databases(1, False)
+    scenario = 'items={items} depth={depth} fanout={fanout} ops={ops} ' \
+               'hardware={hardware}'.format(**vars(args))
+    if args.plan_only:
+        scenario += ' plan'
+    results = run(args)
+    print(scenario)
+    print_results(results)
+    baselines.check(args, scenario, results, counts=('queries', 'rows'))
@@ -0,0 +1,82 @@
+"""
+In-process caches shared across orders.
+"""
+from collections import OrderedDict
+import threading
+import time
+
+
+class TTLCache:
+    """Size-bounded, least-recently-used mapping whose entries expire ttl
+    seconds after they are stored. None is a valid cached value, so negative
+    lookups (e.g., a missing work center) are cached too. Safe to share
+    between threads."""
+    _MISSING = object()
+
+    def __init__(self, maxsize=4096, ttl=3600):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()  # key -> (expires at, value)
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        with self._lock:
+            value = self._get(key)
+            if value is self._MISSING:
+                self.misses += 1
+                return default
+            self.hits += 1
+            return value
+
+    def _get(self, key):
+        entry = self._data.get(key)
+        if entry is None:
+            return self._MISSING
+        expires, value = entry
+        if expires < time.monotonic():
+            del self._data[key]
+            return self._MISSING
+        self._data.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def get_or_load(self, key, loader):
+        """Return the cached value for key, calling loader() to fetch and
+        store it on a miss. loader() runs without holding the lock, so that
+        other threads' lookups do not wait for it; two threads missing the
+        same key at once may both load it."""
+        with self._lock:
+            value = self._get(key)
+            if value is not self._MISSING:
+                self.hits += 1
+                return value
+            self.misses += 1
+        value = loader()
+        self.put(key, value)
+        return value
+
+    def invalidate(self, key=None):
+        """Drop one key, or every entry if key is None."""
+        with self._lock:
+            if key is None:
+                self._data.clear()
+            else:
+                self._data.pop(key, None)
+
+    def stats(self):
+        return {
+            'size': len(self._data),
+            'hits': self.hits,
+            'misses': self.misses,
+        }
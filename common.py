@@ -1,12 +1,16 @@
+import atexit
 import configparser
 import logging
-from logging.handlers import TimedRotatingFileHandler
+from logging.handlers import TimedRotatingFileHandler, QueueHandler, \
+    QueueListener
 import os
+import queue
 import sys
 
 CONFIG_PATH = 'config.ini'
 PAPERLESS_CONFIG = None
 JOBBOSS_CONFIG = None
+_CONFIG_MTIME = None
 
 logger = logging.getLogger('paperless')
 logger.setLevel(logging.DEBUG)
@@ -14,6 +18,25 @@ f = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 ph = logging.StreamHandler(sys.stdout)
 ph.setFormatter(f)
 logger.addHandler(ph)
+_LOG_LISTENER = None
+
+
+def get_logger(subsystem):
+    """Return the logger for one part of the connector, e.g. 'job', named
+    paperless.<subsystem> so it shares the handlers of the paperless logger.
+    Its level can be set in the [Logging] section of the configuration
+    file."""
+    return logger.getChild(subsystem)
+
+
+def on_own_connection(func, *args):
+    """Run func in a worker thread, closing the thread's database connection
+    when it is done."""
+    from django.db import connections
+    try:
+        return func(*args)
+    finally:
+        connections.close_all()
 
 
 class PaperlessConfig:
@@ -22,6 +45,18 @@ class PaperlessConfig:
         self.slug = kwargs.get('slug')
         self.logpath = kwargs.get('logpath')
         self.active = kwargs.get('active')
+        self.workers = int(kwargs.get('workers') or 1)
+        self.prefetch = int(kwargs.get('prefetch') or 0)
+        self.prefetch_max_components = int(
+            kwargs.get('prefetch_max_components') or 2000)
+        self.poll_interval = float(kwargs.get('poll_interval') or 60)
+        self.poll_jitter = float(kwargs.get('poll_jitter') or 10)
+        self.backlog_path = kwargs.get('backlog_path') or None
+        self.backlog_batch = int(kwargs.get('backlog_batch') or 10)
+        self.retry_attempts = int(kwargs.get('retry_attempts') or 5)
+        self.retry_backoff = float(kwargs.get('retry_backoff') or 60)
+        self.log_queue = bool(int(kwargs.get('log_queue') or 0))
+        self.log_levels = kwargs.get('log_levels') or {}
 
 
 class JobBOSSConfig:
@@ -37,36 +72,46 @@ class JobBOSSConfig:
         self.import_material = bool(int(kwargs.get('import_material')))
         self.default_location = kwargs.get('default_location')
         self.import_operations = bool(int(kwargs.get('import_operations')))
+        self.bulk_insert = bool(int(kwargs.get('bulk_insert') or 0))
+        self.lookup_cache_size = int(kwargs.get('lookup_cache_size') or 4096)
+        self.lookup_cache_ttl = int(kwargs.get('lookup_cache_ttl') or 3600)
+        self.customer_cache_path = kwargs.get('customer_cache_path') or None
+        self.instrument_queries = bool(
+            int(kwargs.get('instrument_queries') or 0))
+        self.query_report_dir = kwargs.get('query_report_dir') or None
+        self.ledger_path = kwargs.get('ledger_path') or None
+        self.ledger_update = bool(int(kwargs.get('ledger_update') or 0))
 
 
-def configure(test_mode=False):
-    global PAPERLESS_CONFIG
-    global JOBBOSS_CONFIG
-    logger.info('Reading configuration file')
+def read_config(path):
+    """Return (PaperlessConfig, JobBOSSConfig) parsed from the file at path."""
     parser = configparser.ConfigParser()
-    if test_mode:
-        parser.read('config.example.ini')
-    else:
-        parser.read(CONFIG_PATH)
+    parser.read(path)
 
-    PAPERLESS_CONFIG = PaperlessConfig(
+    paperless_config = PaperlessConfig(
         token=parser['Paperless']['token'],
         slug=parser['Paperless']['slug'],
         logpath=parser['Paperless']['logpath'],
-        active=bool(int(parser['Paperless']['active']))
-    )
-    fh = TimedRotatingFileHandler(
-        PAPERLESS_CONFIG.logpath,
-        backupCount=30,
-        when='midnight',
-        interval=1
+        active=bool(int(parser['Paperless']['active'])),
+        workers=parser['Paperless'].get('workers'),
+        prefetch=parser['Paperless'].get('prefetch'),
+        prefetch_max_components=parser['Paperless'].get(
+            'prefetch_max_components'),
+        poll_interval=parser['Paperless'].get('poll_interval'),
+        poll_jitter=parser['Paperless'].get('poll_jitter'),
+        backlog_path=parser['Paperless'].get('backlog_path'),
+        backlog_batch=parser['Paperless'].get('backlog_batch'),
+        retry_attempts=parser['Paperless'].get('retry_attempts'),
+        retry_backoff=parser['Paperless'].get('retry_backoff'),
+        log_queue=parser['Logging'].get('queue')
+        if parser.has_section('Logging') else None,
+        log_levels={
+            subsystem: level.upper()
+            for subsystem, level in parser['Logging'].items()
+            if subsystem != 'queue'
+        } if parser.has_section('Logging') else None,
     )
-    fh.suffix = '%Y-%m-%d'
-    fh.setFormatter(f)
-    fh.setLevel(logging.INFO)
-    logger.addHandler(fh)
-
-    JOBBOSS_CONFIG = JobBOSSConfig(
+    jobboss_config = JobBOSSConfig(
         host=parser['JobBOSS']['host'],
         instance=parser['JobBOSS'].get('instance'),
         port=parser['JobBOSS'].get('port'),
@@ -78,7 +123,47 @@ def configure(test_mode=False):
         import_material=parser['JobBOSS']['import_material'],
         default_location=parser['JobBOSS']['default_location'],
         import_operations=parser['JobBOSS']['import_operations'],
+        bulk_insert=parser['JobBOSS'].get('bulk_insert'),
+        lookup_cache_size=parser['JobBOSS'].get('lookup_cache_size'),
+        lookup_cache_ttl=parser['JobBOSS'].get('lookup_cache_ttl'),
+        customer_cache_path=parser['JobBOSS'].get('customer_cache_path'),
+        instrument_queries=parser['JobBOSS'].get('instrument_queries'),
+        query_report_dir=parser['JobBOSS'].get('query_report_dir'),
+        ledger_path=parser['JobBOSS'].get('ledger_path'),
+        ledger_update=parser['JobBOSS'].get('ledger_update'),
     )
+    return paperless_config, jobboss_config
+
+
+def configure(test_mode=False):
+    global PAPERLESS_CONFIG
+    global JOBBOSS_CONFIG
+    global _CONFIG_MTIME
+    logger.info('Reading configuration file')
+    if test_mode:
+        PAPERLESS_CONFIG, JOBBOSS_CONFIG = read_config('config.example.ini')
+        # keep tests and benchmarks from sharing SQLite files between runs
+        PAPERLESS_CONFIG.backlog_path = None
+        JOBBOSS_CONFIG.customer_cache_path = None
+        JOBBOSS_CONFIG.ledger_path = None
+    else:
+        _CONFIG_MTIME = _config_mtime()
+        PAPERLESS_CONFIG, JOBBOSS_CONFIG = read_config(CONFIG_PATH)
+
+    fh = TimedRotatingFileHandler(
+        PAPERLESS_CONFIG.logpath,
+        backupCount=30,
+        when='midnight',
+        interval=1
+    )
+    fh.suffix = '%Y-%m-%d'
+    fh.setFormatter(f)
+    fh.setLevel(logging.INFO)
+    logger.addHandler(fh)
+    if PAPERLESS_CONFIG.log_queue:
+        start_log_queue()
+    set_log_levels(PAPERLESS_CONFIG.log_levels)
+
     os.environ.setdefault('JOBBOSS_DB_HOST', JOBBOSS_CONFIG.host)
     os.environ.setdefault('JOBBOSS_DB_NAME', JOBBOSS_CONFIG.name)
     os.environ.setdefault('JOBBOSS_DB_USERNAME', JOBBOSS_CONFIG.user)
@@ -89,3 +174,66 @@ def configure(test_mode=False):
         os.environ.setdefault('JOBBOSS_DB_PORT', JOBBOSS_CONFIG.port)
     if test_mode:
         os.environ.setdefault('JOBBOSS_TEST', '1')
+
+
+def start_log_queue():
+    """Move the log handlers onto a background thread, so that writing to
+    the console and log file does not block the import."""
+    global _LOG_LISTENER
+    if _LOG_LISTENER is not None:
+        return
+    q = queue.SimpleQueue()
+    handlers = list(logger.handlers)
+    for handler in handlers:
+        logger.removeHandler(handler)
+    logger.addHandler(QueueHandler(q))
+    _LOG_LISTENER = QueueListener(q, *handlers, respect_handler_level=True)
+    _LOG_LISTENER.start()
+    atexit.register(_LOG_LISTENER.stop)
+
+
+def set_log_levels(levels):
+    for subsystem, level in levels.items():
+        get_logger(subsystem).setLevel(level)
+
+
+def _config_mtime():
+    try:
+        return os.path.getmtime(CONFIG_PATH)
+    except OSError:
+        return None
+
+
+def reload_config_if_changed():
+    """Re-read the configuration file if it was modified since it was last
+    read. Returns True if it was reloaded. Database connection settings, the
+    log file path, the log queue and the paths of the backlog, ledger and
+    customer cache, which are opened once, only take effect after a
+    restart."""
+    global PAPERLESS_CONFIG
+    global JOBBOSS_CONFIG
+    global _CONFIG_MTIME
+    mtime = _config_mtime()
+    if mtime is None or mtime == _CONFIG_MTIME:
+        return False
+    try:
+        paperless_config, jobboss_config = read_config(CONFIG_PATH)
+    except (KeyError, ValueError, configparser.Error) as e:
+        logger.error('Ignoring invalid configuration file: %s', e)
+        return False
+    _CONFIG_MTIME = mtime
+    restart = [k for k in ('logpath', 'backlog_path')
+               if getattr(paperless_config, k) != getattr(PAPERLESS_CONFIG, k)]
+    restart += [k for k in ('host', 'instance', 'port', 'name', 'user',
+                            'password', 'ledger_path', 'customer_cache_path')
+                if getattr(jobboss_config, k) != getattr(JOBBOSS_CONFIG, k)]
+    if paperless_config.log_queue != PAPERLESS_CONFIG.log_queue:
+        restart.append('the [Logging] queue option')
+    if restart:
+        logger.warning('Restart the connector to apply changes to %s',
+                       ', '.join(restart))
+    PAPERLESS_CONFIG = paperless_config
+    JOBBOSS_CONFIG = jobboss_config
+    set_log_levels(PAPERLESS_CONFIG.log_levels)
+    logger.info('Reloaded configuration file')
+    return True
@@ -1,78 +1,179 @@
+"""
+Command line entry point. Arguments are parsed before anything else is
+loaded, and each mode imports only the modules it needs, so that quick modes
+such as --test do not pay for loading the Paperless SDK and the whole import
+pipeline. Run python startup_benchmark.py to measure start-up time.
+"""
 import argparse
+import json
 import sys
 import common
-from common import logger
-from paperless.client import PaperlessClient
-from paperless.listeners import OrderListener
-from paperless.main import PaperlessSDK
-from paperless.objects.orders import Order
-common.configure()
-from job import process_order
 
+logger = common.get_logger('connector')
 
-class MyOrderListener(OrderListener):
-    def on_event(self, resource):
-        if resource.status != 'cancelled':
-            process_order(resource)
 
+def verify_order(order, force=False):
+    """Import order between two scoped snapshots and write what it changed
+    to order_<number>_changes.<table>.jsonl."""
+    from job import process_order
+    from snapshot import create_scoped_snapshot, compare_snapshots
+    prefix = 'order_{}'.format(order.number)
+    create_scoped_snapshot(prefix + '_before')
+    try:
+        process_order(order, force=force)
+    finally:
+        create_scoped_snapshot(prefix + '_after', prefix + '_before')
+        compare_snapshots(prefix + '_before', prefix + '_after',
+                          prefix + '_changes')
 
-def main():
-    PaperlessClient(
-        access_token=common.PAPERLESS_CONFIG.token,
-        group_slug=common.PAPERLESS_CONFIG.slug
-    )
-    my_sdk = PaperlessSDK(loop=False)
-    listener = MyOrderListener()
-    my_sdk.add_listener(listener)
-    my_sdk.run()
+
+def write_plan(order, path):
+    """Write the rows importing order would write as JSON to path, or to
+    stdout if path is '-'."""
+    from job import plan_order
+    plan = plan_order(order)
+    if path == '-':
+        json.dump(plan, sys.stdout, indent=2, default=str)
+    else:
+        with open(path, 'w') as f:
+            json.dump(plan, f, indent=2, default=str)
+    logger.info('Importing order %s would write %d rows', order.number,
+                len(plan))
+
+
+def started(args):
+    """Exit if only measuring start-up, once the mode has loaded its
+    modules; see startup_benchmark.py."""
+    if args.startup_only:
+        sys.exit(0)
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--order_num')
+    parser.add_argument('--force', action='store_true',
+                        help='Import --order_num even if it was already '
+                             'imported.')
+    parser.add_argument('--verify', action='store_true',
+                        help='Snapshot the tables --order_num touches before '
+                             'and after importing it, and report the '
+                             'changes.')
+    parser.add_argument('--plan', nargs='?', const='-', default=None,
+                        help='Instead of importing --order_num, write the '
+                             'rows it would create as JSON to this file, or '
+                             'to the screen if no file is given.')
     parser.add_argument('--test', action='store_true')
+    parser.add_argument('--retry_failed', action='store_true',
+                        help='Retry the orders in the backlog that failed '
+                             'retry_attempts times, then check for new '
+                             'orders as usual.')
+    parser.add_argument('--clear_cache', action='store_true',
+                        help='Make a connector running with --daemon reload '
+                             'work centers, vendors and operations from '
+                             'JobBOSS at its next poll.')
+    parser.add_argument('--daemon', action='store_true',
+                        help='Keep running and check for new orders every '
+                             'poll_interval seconds.')
     parser.add_argument('--create_db_snapshot', action='store_true')
     parser.add_argument('--compare_db_snapshots', action='store_true')
     parser.add_argument('--snapshot_file_path', default=None, type=str,
-                        help='The file path for the snapshot pickle file. If you are creating a new snapshot, you '
+                        help='The folder for the snapshot. If you are creating a new snapshot, you '
                              'may specify the path with this argument. If you are comparing two existing snapshots, '
                              'this is the path of the "new" snapshot and this must be supplied.')
     parser.add_argument('--old_snapshot_file_path', default=None, type=str,
-                        help='When comparing two snapshots, this is the file path of the "old" snapshot.')
+                        help='When comparing two snapshots, this is the folder of the "old" snapshot. When '
+                             'creating an incremental snapshot, this is its base snapshot.')
+    parser.add_argument('--incremental', action='store_true',
+                        help='When creating a snapshot, only capture rows updated since the snapshot at '
+                             '--old_snapshot_file_path.')
+    parser.add_argument('--scoped', action='store_true',
+                        help='When creating a snapshot, only capture the tables the connector writes, and only '
+                             'rows added or updated since the watermark of --old_snapshot_file_path, or since '
+                             'now if it is not given.')
+    parser.add_argument('--diff_report_path', default=None, type=str,
+                        help='When comparing two snapshots, write the changed rows of each table to '
+                             '<path>.<table>.jsonl.')
+    parser.add_argument('--startup_only', action='store_true',
+                        help=argparse.SUPPRESS)
     args = parser.parse_args()
+    if args.order_num is None:
+        for flag in ('plan', 'verify', 'force'):
+            if getattr(args, flag):
+                parser.error('--{} requires --order_num'.format(flag))
+    common.configure(test_mode=args.startup_only)
+    if args.retry_failed:
+        from backlog import get_backlog
+        logger.info('Retrying %d failed orders',
+                    get_backlog().retry_failed())
 
     if args.order_num is not None:
-        PaperlessClient(
-            access_token=common.PAPERLESS_CONFIG.token,
-            group_slug=common.PAPERLESS_CONFIG.slug
-        )
+        from paperless.objects.orders import Order
+        from listener import connect_paperless, warm_caches
+        from job import process_order
+        started(args)
+        connect_paperless()
         order = Order.get(args.order_num)
-        process_order(order)
+        warm_caches()
+        if args.plan:
+            write_plan(order, args.plan)
+        elif args.verify:
+            verify_order(order, force=args.force)
+        else:
+            process_order(order, force=args.force)
     elif args.test:
         print('Testing JobBOSS Connection')
         print('Host:', common.JOBBOSS_CONFIG.host)
         print('Database:', common.JOBBOSS_CONFIG.name)
         print('Username:', common.JOBBOSS_CONFIG.user)
         from jobboss.models import Job
+        started(args)
         c = Job.objects.count()
         print('Job count: {} OK!'.format(c))
     elif args.create_db_snapshot:
+        from datetime import datetime
         if args.snapshot_file_path is None:
             now = datetime.now().strftime('%Y.%m.%d.%H.%M.%S')
-            database_snapshot_file_path = f'database_snapshot_{now}.pickle'
+            database_snapshot_file_path = f'database_snapshot_{now}'
         else:
             database_snapshot_file_path = args.snapshot_file_path
+        if args.incremental and args.old_snapshot_file_path is None:
+            raise ValueError('Must supply --old_snapshot_file_path when creating an incremental snapshot.')
         print(f'Creating a snapshot of the database: {database_snapshot_file_path}')
-        from jobboss.utils.database_diff import create_database_snapshot
-        create_database_snapshot(database_snapshot_file_path)
+        if args.scoped:
+            from snapshot import create_scoped_snapshot
+            started(args)
+            create_scoped_snapshot(database_snapshot_file_path,
+                                   args.old_snapshot_file_path)
+        else:
+            from snapshot import create_snapshot
+            started(args)
+            create_snapshot(database_snapshot_file_path,
+                            args.old_snapshot_file_path if args.incremental else None)
     elif args.compare_db_snapshots:
         if args.snapshot_file_path is None or args.old_snapshot_file_path is None:
             raise ValueError('Must supply both --snapshot_file_path and --old_snapshot_file_path when comparing snapshots.')
-        from jobboss.utils.database_diff import compare_database_snapshots
-        compare_database_snapshots(args.old_snapshot_file_path, args.snapshot_file_path)
+        from snapshot import compare_snapshots
+        started(args)
+        compare_snapshots(args.old_snapshot_file_path, args.snapshot_file_path,
+                          args.diff_report_path)
+    elif args.clear_cache:
+        from routing import request_cache_clear
+        started(args)
+        request_cache_clear()
+        print('The running connector will reload its lookup cache at its '
+              'next poll')
+    elif args.daemon:
+        from listener import run_daemon
+        started(args)
+        try:
+            run_daemon()
+        except KeyboardInterrupt:
+            logger.info('Stopping connector')
     else:
         if common.PAPERLESS_CONFIG.active:
             logger.info('Running connector!')
+            from listener import main
+            started(args)
             main()
         else:
             logger.debug('Inactive')
@@ -0,0 +1,207 @@
+"""
+Resolves the JobBOSS customer, contact, billing and shipping addresses, and
+sales rep for an order. The keys found for a customer are cached, optionally
+in a local SQLite file, so repeat customers skip the get_or_create queries.
+A cached entry is only used while the customer's last_updated is unchanged,
+its addresses still exist and its contact still exists with the cached
+billing address; other edits to the contact or addresses do not invalidate
+it.
+"""
+import attr
+import json
+import sqlite3
+import threading
+from django.db import transaction
+from django.db.models import Exists
+from cache import TTLCache
+import common
+from paperless.objects.orders import Order
+import jobboss.models as jb
+from jobboss.query.customer import get_or_create_customer, \
+    get_or_create_contact, get_or_create_address, get_default_billing_address, get_default_shipping_address
+
+logger = common.get_logger('customers')
+
+
+@attr.s(frozen=True)
+class CustomerKeys:
+    customer = attr.ib()
+    contact = attr.ib()
+    bill_to = attr.ib()
+    ship_to = attr.ib()
+    last_updated = attr.ib()  # Customer.last_updated when cached, as str
+
+
+def get_customer_name(order: Order):
+    """Return the (business name, ERP code) used to find or create the JobBOSS
+    customer for order."""
+    if order.customer.company:
+        return order.customer.company.business_name, \
+            order.customer.company.erp_code
+    else:
+        return '{}, {}'.format(order.customer.last_name,
+                               order.customer.first_name), None
+
+
+def customer_key(order: Order):
+    """The ERP code, or else the name, by which the JobBOSS customer for
+    order is found."""
+    business_name, code = get_customer_name(order)
+    return code or business_name
+
+
+def get_bill_name(order: Order):
+    if order.billing_info is not None:
+        return '{} {}'.format(order.billing_info.first_name,
+                              order.billing_info.last_name)
+    return '{} {}'.format(order.customer.first_name,
+                          order.customer.last_name)
+
+
+def normalize_address(info):
+    if info is None:
+        return None
+    return {k: v.strip().upper() if isinstance(v, str) else v
+            for k, v in attr.asdict(info).items()}
+
+
+def cache_key(order: Order):
+    return json.dumps([
+        customer_key(order),
+        get_bill_name(order),
+        normalize_address(order.billing_info),
+        normalize_address(order.shipping_info),
+    ], sort_keys=True, default=str)
+
+
+class CustomerCache:
+    """In-process cache of CustomerKeys, backed by a SQLite file if a path is
+    given."""
+
+    def __init__(self, path=None):
+        self._memory = TTLCache(maxsize=1024, ttl=24 * 3600)
+        self._db = None
+        self._lock = threading.Lock()
+        if path:
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS customer_keys ('
+                'key TEXT PRIMARY KEY, customer TEXT, contact INTEGER, '
+                'bill_to INTEGER, ship_to INTEGER, last_updated TEXT)')
+            self._db.commit()
+
+    def get(self, key):
+        keys = self._memory.get(key)
+        if keys is None and self._db is not None:
+            with self._lock:
+                row = self._db.execute(
+                    'SELECT customer, contact, bill_to, ship_to, last_updated '
+                    'FROM customer_keys WHERE key = ?', (key,)).fetchone()
+            if row:
+                keys = CustomerKeys(*row)
+                self._memory.put(key, keys)
+        return keys
+
+    def put(self, key, keys: CustomerKeys):
+        self._memory.put(key, keys)
+        if self._db is not None:
+            with self._lock:
+                self._db.execute(
+                    'INSERT OR REPLACE INTO customer_keys VALUES '
+                    '(?, ?, ?, ?, ?, ?)', (key,) + attr.astuple(keys))
+                self._db.commit()
+
+    def invalidate(self, key=None):
+        self._memory.invalidate(key)
+        if self._db is not None:
+            with self._lock:
+                if key is None:
+                    self._db.execute('DELETE FROM customer_keys')
+                else:
+                    self._db.execute(
+                        'DELETE FROM customer_keys WHERE key = ?', (key,))
+                self._db.commit()
+
+    def stats(self):
+        return self._memory.stats()
+
+
+CUSTOMER_CACHE = None
+EMPLOYEE_CACHE = TTLCache(maxsize=256, ttl=3600)
+
+
+def get_customer_cache():
+    global CUSTOMER_CACHE
+    if CUSTOMER_CACHE is None:
+        CUSTOMER_CACHE = CustomerCache(common.JOBBOSS_CONFIG.customer_cache_path)
+    return CUSTOMER_CACHE
+
+
+def get_sales_rep(customer: jb.Customer):
+    """Return the Employee who is the customer's sales rep, or None."""
+    if not customer.sales_rep:
+        return None
+    return EMPLOYEE_CACHE.get_or_load(
+        customer.sales_rep,
+        lambda: jb.Employee.objects.filter(employee=customer.sales_rep).first()
+    )
+
+
+def resolve_customer(order: Order):
+    """Return (customer, keys) for order, creating the customer, contact and
+    addresses in JobBOSS as needed."""
+    customer_cache = get_customer_cache()
+    key = cache_key(order)
+    keys = customer_cache.get(key)
+    if keys is not None:
+        # one query, checking the cached rows were not deleted and the
+        # contact was not moved to another billing address meanwhile
+        customer = jb.Customer.objects.filter(customer=keys.customer).annotate(
+            has_contact=Exists(jb.Contact.objects.filter(
+                contact=keys.contact, address=keys.bill_to)),
+            has_bill_to=Exists(jb.Address.objects.filter(address=keys.bill_to)),
+            has_ship_to=Exists(jb.Address.objects.filter(address=keys.ship_to)),
+        ).first()
+        if customer is not None and \
+                str(customer.last_updated) == keys.last_updated and \
+                customer.has_contact and customer.has_bill_to and \
+                customer.has_ship_to:
+            return customer, keys
+        logger.info('Customer %s or its contact or addresses changed since '
+                    'it was cached', keys.customer)
+        customer_cache.invalidate(key)
+
+    business_name, code = get_customer_name(order)
+    customer: jb.Customer = get_or_create_customer(business_name, code)
+    contact: jb.Contact = get_or_create_contact(customer, get_bill_name(order))
+    if order.billing_info:
+        bill_to: jb.Address = get_or_create_address(
+            customer,
+            attr.asdict(order.billing_info),
+            is_shipping=False
+        )
+    else:
+        bill_to: jb.Address = get_default_billing_address(customer)
+    if contact.address != bill_to.address:
+        contact.address = bill_to.address
+        contact.save(update_fields=['address'])
+    if order.shipping_info:
+        ship_to: jb.Address = get_or_create_address(
+            customer,
+            attr.asdict(order.shipping_info),
+            is_shipping=True
+        )
+    else:
+        ship_to: jb.Address = get_default_shipping_address(customer)
+
+    customer.refresh_from_db(fields=['last_updated'])
+    keys = CustomerKeys(
+        customer=customer.customer,
+        contact=contact.contact,
+        bill_to=bill_to.address,
+        ship_to=ship_to.address,
+        last_updated=str(customer.last_updated),
+    )
+    # rows created here disappear if the order is rolled back
+    transaction.on_commit(lambda: customer_cache.put(key, keys))
+    return customer, keys
@@ -0,0 +1,125 @@
+"""
+Optional instrumentation of the SQL issued while importing an order. A
+QueryRecorder installed as a Django execute wrapper attributes every statement
+to the connector source line and import phase that caused it, and flags
+statements repeated from one line (N+1 patterns) or repeated verbatim.
+"""
+import json
+import os
+import sys
+import time
+import common
+
+logger = common.get_logger('instrument')
+
+SOURCE_FILES = frozenset((
+    'job.py',
+    'routing.py',
+    'customers.py',
+    'autonumber.py',
+    'writer.py',
+))
+"""Connector modules queries are attributed to"""
+
+
+class QueryRecorder:
+    def __init__(self, timer=None, repeat_threshold=5):
+        self.timer = timer
+        self.repeat_threshold = repeat_threshold
+        self.count = 0
+        self.seconds = 0.
+        self.phases = {}  # phase -> {'queries', 'rows', 'seconds'}
+        self.sites = {}  # 'file:line (function)' -> {'queries', 'seconds'}
+        self.statements = {}  # (site, sql) -> [count, set of param hashes]
+        self.exact = {}  # (sql, param hash) -> [count, sample params]
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self._record(sql, params, context, time.perf_counter() - start)
+
+    def _record(self, sql, params, context, elapsed):
+        phase = (self.timer.current if self.timer else None) or 'other'
+        site = self._call_site()
+        self.count += 1
+        self.seconds += elapsed
+        p = self.phases.setdefault(
+            phase, {'queries': 0, 'rows': 0, 'seconds': 0.})
+        p['queries'] += 1
+        p['seconds'] += elapsed
+        if sql.lstrip()[:6].upper() in ('INSERT', 'UPDATE', 'DELETE'):
+            p['rows'] += max(context['cursor'].rowcount, 0)
+        s = self.sites.setdefault(site, {'queries': 0, 'seconds': 0.})
+        s['queries'] += 1
+        s['seconds'] += elapsed
+        param_repr = repr(params)
+        param_hash = hash(param_repr)
+        stmt = self.statements.setdefault((site, sql), [0, set()])
+        stmt[0] += 1
+        stmt[1].add(param_hash)
+        exact = self.exact.setdefault((sql, param_hash), [0, param_repr[:200]])
+        exact[0] += 1
+
+    @staticmethod
+    def _call_site():
+        frame = sys._getframe(2)
+        while frame is not None:
+            filename = os.path.basename(frame.f_code.co_filename)
+            if filename in SOURCE_FILES:
+                return '{}:{} ({})'.format(
+                    filename, frame.f_lineno, frame.f_code.co_name)
+            frame = frame.f_back
+        return 'other'
+
+    def n_plus_one(self):
+        """Statements run repeat_threshold or more times from one line with
+        different parameters."""
+        return [
+            {'site': site, 'sql': sql[:200], 'queries': n,
+             'distinct_params': len(params)}
+            for (site, sql), (n, params) in self.statements.items()
+            if n >= self.repeat_threshold and len(params) > 1
+        ]
+
+    def duplicates(self):
+        """Statements run more than once with identical parameters."""
+        return [
+            {'sql': sql[:200], 'params': params, 'queries': n}
+            for (sql, _), (n, params) in self.exact.items() if n > 1
+        ]
+
+    def summary(self):
+        return {
+            'queries': self.count,
+            'seconds': round(self.seconds, 4),
+            'phases': {
+                phase: dict(p, seconds=round(p['seconds'], 4))
+                for phase, p in self.phases.items()
+            },
+            'sites': {
+                site: dict(s, seconds=round(s['seconds'], 4))
+                for site, s in sorted(self.sites.items(),
+                                      key=lambda kv: -kv[1]['queries'])
+            },
+            'n_plus_one': self.n_plus_one(),
+            'duplicates': self.duplicates(),
+        }
+
+    def report(self, label, path=None):
+        """Log a summary and, if path is given, write the details as JSON."""
+        summary = self.summary()
+        logger.info('%s: %d queries in %.3fs; %s', label, self.count,
+                    self.seconds, ', '.join(
+                        '{} {}'.format(phase, p['queries'])
+                        for phase, p in summary['phases'].items()))
+        for site, s in list(summary['sites'].items())[:5]:
+            logger.info('%s: %d queries from %s', label, s['queries'], site)
+        for n1 in summary['n_plus_one']:
+            logger.warning('%s: possible N+1, %d queries from %s: %s', label,
+                           n1['queries'], n1['site'], n1['sql'])
+        if path:
+            with open(path, 'w') as f:
+                json.dump(summary, f, indent=2)
+        return summary
@@ -1,16 +1,46 @@
-import attr
 import datetime
+import os
 import uuid
+from contextlib import contextmanager, nullcontext
 from itertools import chain
-from common import logger
+import attr
 import common
+from django.db import connection, transaction, IntegrityError
 from paperless.objects.components import Operation
 from paperless.objects.orders import Order, OrderComponent
 import jobboss.models as jb
-from jobboss.query.customer import get_or_create_customer, \
-    get_or_create_contact, get_or_create_address, get_default_billing_address, get_default_shipping_address
-from jobboss.query.job import get_material, AssemblySuffixCounter
-from routing import generate_routing_lines
+from assembly import AssemblyIndex
+from autonumber import AutoNumberAllocator
+from customers import resolve_customer, get_sales_rep
+from instrument import QueryRecorder
+from ledger import LedgerEntry, get_ledger, header_hash, order_hash
+from routing import get_routing_plan, LOOKUP_CACHE
+import templates
+from timing import PhaseTimer
+from writer import RowWriter, PlanWriter
+
+logger = common.get_logger('job')
+
+@attr.s(frozen=True)
+class OrderContext:
+    """The rows and settings shared by all items of an order being
+    imported."""
+    order = attr.ib()
+    so_header = attr.ib()
+    customer_keys = attr.ib()
+    assemblies = attr.ib()  # AssemblyIndex of each order item
+    materials = attr.ib()  # as returned by resolve_materials()
+    job_template = attr.ib()
+    operation_template = attr.ib()
+    material_template = attr.ib()
+    hardware_template = attr.ib()
+    import_operations = attr.ib()
+    routing_plan = attr.ib()
+    sales_code = attr.ib()
+    import_material = attr.ib()
+    commission_pct = attr.ib()
+    now = attr.ib()
+    today = attr.ib()
 
 
 def safe_round(f):
@@ -20,52 +50,380 @@ def safe_round(f):
         return f
 
 
-def process_order(order: Order):
+def split_description(description):
+    """Split a component description into JobBOSS description (30
+    characters) and extended description."""
+    if not description:
+        return None, None
+    if len(description) <= 30:
+        return description, None
+    return description[0:30], description[30:]
+
+
+def material_key(part_number):
+    """Key for matching part numbers to materials the way SQL Server compares
+    them, ignoring case and trailing spaces."""
+    return part_number.rstrip().upper()
+
+
+def order_notes(order: Order):
+    notes = 'PP Quote #{}'.format(order.quote_number)
+    if order.private_notes:
+        notes += '\r\n\r\n{}'.format(order.private_notes)
+    return notes
+
+
+def item_notes(order_item):
+    return '\n\n'.join(
+        n for n in (order_item.public_notes, order_item.private_notes) if n)
+
+
+def customer_po(order: Order):
+    po = order.payment_details.purchase_order_number
+    return po[:20] if po is not None else None
+
+
+def shipping_summary(order: Order):
+    if order.shipping_option is None:
+        return ''
+    return order.shipping_option.summary(
+        order.ships_on_dt, order.payment_details.payment_type)
+
+
+MATERIAL_QUERY_CHUNK = 1000
+"""Part numbers per IN query, well under SQL Server's parameter limit"""
+
+MATERIAL_CREATE_ATTEMPTS = 3
+"""Times to look up and create an order's materials when other imports keep
+creating some of the same part numbers first"""
+
+
+def resolve_materials(order: Order, assemblies, import_material, sales_code,
+                      default_location, writer: RowWriter):
+    """Find the material master for every part number in order with one
+    query, and create any missing ones (type 'F' for manufactured components,
+    'H' for hardware) with one bulk insert through writer if import_material
+    is set. assemblies holds the AssemblyIndex of each order item.
+    Manufactured components are only looked up if import_material is set.
+    Returns a dict of material_key -> jb.Material, or None if there is no
+    material."""
+    first_use = {}  # material key -> (component, order item) first using it
+    for order_item, assembly in zip(order.order_items, assemblies):
+        for assm_comp, _ in assembly.manufactured:
+            comp: OrderComponent = assm_comp.component
+            if comp.part_number and import_material:
+                first_use.setdefault(material_key(comp.part_number),
+                                     (comp, order_item))
+        for comp, _ in assembly.hardware:
+            if comp.part_number:
+                first_use.setdefault(material_key(comp.part_number),
+                                     (comp, order_item))
+
+    materials = dict.fromkeys(first_use)
+    keys = list(first_use)
+    for n in range(0, len(keys), MATERIAL_QUERY_CHUNK):
+        part_numbers = [first_use[key][0].part_number
+                        for key in keys[n:n + MATERIAL_QUERY_CHUNK]]
+        for material in jb.Material.objects.filter(material__in=part_numbers):
+            materials[material_key(material.material)] = material
+    logger.info('Found %d of %d materials',
+                sum(1 for m in materials.values() if m), len(materials))
+
+    if not import_material:
+        return materials
+    new_materials = []
+    for key, material in materials.items():
+        if material:
+            continue
+        comp, order_item = first_use[key]
+        if comp.is_hardware:
+            logger.info('Creating hardware Material %s', comp.part_number)
+            material = jb.Material(
+                material=comp.part_number,
+                description=comp.description[0:30] if comp.description else None,
+                sales_code=sales_code,
+                rev=comp.revision,
+                location_id=default_location,
+                type='H',
+                status='Active',
+                pick_buy_indicator='B',
+                stocked_uofm='ea',
+                purchase_uofm='ea',
+                cost_uofm='ea',
+                price_uofm='ea',
+                standard_cost=0.0,
+                reorder_qty=0,
+                lead_days=0,
+                uofm_conv_factor=1,
+                lot_trace=False,
+                rd_whole_unit=False,
+                make_buy='B',
+                use_price_breaks=True,
+                last_updated=datetime.datetime.utcnow(),
+                taxable=False,
+                affects_schedule=False,
+                tooling=False,
+                isserialized=False,
+                objectid=uuid.uuid4()
+            )
+        else:
+            logger.info('Creating Material %s', comp.part_number)
+            desc, ext_desc = split_description(comp.description)
+            # calculate the standard cost as the sum of all operations
+            cost = 0
+            for op in chain(comp.material_operations, comp.shop_operations):
+                cost += op.cost.dollars
+            if order_item.quantity:
+                cost = cost / order_item.quantity
+            material = jb.Material(
+                material=comp.part_number,
+                description=desc,
+                ext_description=ext_desc,
+                sales_code=sales_code,
+                rev=comp.revision,
+                location_id=default_location,
+                type='F',
+                status='Active',
+                pick_buy_indicator='P',
+                stocked_uofm='ea',
+                purchase_uofm='ea',
+                cost_uofm='ea',
+                price_uofm='ea',
+                selling_price=order_item.unit_price.dollars,
+                standard_cost=cost,
+                reorder_qty=0,
+                lead_days=0,
+                uofm_conv_factor=1,
+                lot_trace=False,
+                rd_whole_unit=False,
+                make_buy='M',
+                use_price_breaks=True,
+                last_updated=datetime.datetime.utcnow(),
+                taxable=False,
+                affects_schedule=True,
+                tooling=False,
+                isserialized=False,
+                objectid=uuid.uuid4()
+            )
+        materials[key] = material
+        new_materials.append(material)
+    writer.save_all(new_materials)
+    return materials
+
+
+def create_materials(order: Order, assemblies, writer: RowWriter = None):
+    """resolve_materials() for an order about to be imported, creating the
+    missing materials through writer, by default a new RowWriter, in a short
+    transaction of their own ahead of the order's. Orders imported at the
+    same time may need the same new part number; if another import commits
+    it first, the insert fails on the duplicate key and the materials are
+    looked up again. Materials created here are kept if the order then
+    fails to import."""
+    config = common.JOBBOSS_CONFIG
+    for attempt in range(1, MATERIAL_CREATE_ATTEMPTS + 1):
+        try:
+            with transaction.atomic():
+                return resolve_materials(
+                    order, assemblies, config.import_material,
+                    config.sales_code, config.default_location or None,
+                    writer or RowWriter())
+        except IntegrityError:
+            if attempt == MATERIAL_CREATE_ATTEMPTS:
+                raise
+            logger.info('Another import created materials of order %s; '
+                        'looking them up again', order.number)
+
+
+def imported_sales_order(order_number):
+    """Return the JobBOSS sales order order_number was imported as, found by
+    the link to the order added to every imported sales order, or None."""
+    return jb.Attachment.objects.filter(
+        owner_type='SOHeader',
+        description='PP Order #{}'.format(order_number),
+    ).values_list('owner_id', flat=True).order_by('-owner_id').first()
+
+
+def process_order(order: Order, timer: PhaseTimer = None, force=False):
+    """Import order into JobBOSS in a single transaction; nothing is written
+    unless the whole order succeeds. AutoNumber keys are reserved beforehand
+    in their own short transaction; they are not returned if the import
+    fails. New materials are created just before, also in their own
+    transaction; see create_materials().
+
+    Orders already in the ledger are skipped unless force is set. If the
+    order has changed since it was imported and ledger_update is set, the
+    sales order and order lines are updated in place instead. Returns the
+    LedgerEntry of the order, or None if it was not imported."""
+    ledger = get_ledger()
+    entry = None if force else ledger.get(order.number)
+    if entry is not None:
+        return _reimport_order(order, entry)
+    timer = timer or PhaseTimer()
+    recorder = QueryRecorder(timer) \
+        if common.JOBBOSS_CONFIG.instrument_queries else None
+    try:
+        with connection.execute_wrapper(recorder) if recorder \
+                else nullcontext():
+            timer.switch('autonumber')
+            allocator = AutoNumberAllocator()
+            allocator.reserve_for_order(order)
+            timer.switch('materials')
+            assemblies = [AssemblyIndex(order_item)
+                          for order_item in order.order_items]
+            materials = create_materials(order, assemblies)
+            writer = RowWriter(bulk=common.JOBBOSS_CONFIG.bulk_insert)
+            with transaction.atomic():
+                sales_order, jobs = _import_order(order, timer, allocator,
+                                                  writer, assemblies,
+                                                  materials)
+                entry = LedgerEntry.for_order(order, sales_order, jobs)
+                transaction.on_commit(lambda: ledger.record(entry))
+        return entry
+    finally:
+        timer.report('Order {}'.format(order.number))
+        logger.info('Lookup cache %s', LOOKUP_CACHE.stats())
+        if recorder:
+            report_dir = common.JOBBOSS_CONFIG.query_report_dir
+            recorder.report(
+                'Order {} SQL'.format(order.number),
+                os.path.join(report_dir, 'queries-{}.json'.format(
+                    order.number)) if report_dir else None)
+
+
+def plan_order(order: Order, timer: PhaseTimer = None):
+    """Return the rows importing order would write, in the order they would
+    be written, as {'model', 'table', 'fields'} dicts, without writing to
+    JobBOSS. AutoNumber keys follow the current AutoNumber values, and
+    identity keys are provisional negative numbers. Matching the customer
+    may create rows, as in a real import; they are rolled back and not
+    listed."""
+    timer = timer or PhaseTimer()
+    writer = PlanWriter(bulk=common.JOBBOSS_CONFIG.bulk_insert)
+    try:
+        with transaction.atomic():
+            timer.switch('materials')
+            assemblies = [AssemblyIndex(order_item)
+                          for order_item in order.order_items]
+            materials = create_materials(order, assemblies, writer)
+            _import_order(order, timer, AutoNumberAllocator(dry_run=True),
+                          writer, assemblies, materials)
+            transaction.set_rollback(True)
+    finally:
+        timer.report('Plan for order {}'.format(order.number))
+    return writer.records()
+
+
+def _reimport_order(order: Order, entry: LedgerEntry):
+    if order_hash(order) == entry.content_hash:
+        logger.info('Order %s was already imported as sales order %s on %s; '
+                    'skipping', order.number, entry.sales_order,
+                    entry.imported_at)
+        return entry
+    if not common.JOBBOSS_CONFIG.ledger_update:
+        logger.warning('Order %s changed since it was imported as sales '
+                       'order %s; skipping. Set ledger_update to update it, '
+                       'or import it again with --force', order.number,
+                       entry.sales_order)
+        return None
+    if entry.structure_changed(order):
+        logger.warning('Order %s items or components changed since it was '
+                       'imported as sales order %s; it cannot be updated in '
+                       'place. Import it again with --force', order.number,
+                       entry.sales_order)
+        return None
+    with transaction.atomic():
+        _update_order(order, entry)
+        updated = LedgerEntry.for_order(order, entry.sales_order, entry.jobs)
+        transaction.on_commit(lambda: get_ledger().record(updated))
+    return updated
+
+
+def _update_order(order: Order, entry: LedgerEntry):
+    """Bring the prices, quantities, dates and notes of sales order
+    entry.sales_order, its lines, their deliveries and the jobs of each line
+    up to date with order, updating only the header and the order items
+    whose hashes changed; a header change updates the PO number of every
+    job. Deliveries that have started shipping are left as they are, with a
+    warning. Customer and address changes are not applied."""
+    now = datetime.datetime.now()
+    if header_hash(order) != entry.header_hash:
+        jb.SoHeader.objects.filter(sales_order=entry.sales_order).update(
+            promised_date=order.ships_on_dt,
+            customer_po=customer_po(order),
+            total_price=order.payment_details.total_price.dollars,
+            note_text=order_notes(order),
+            comment=shipping_summary(order),
+            last_updated=now,
+        )
+        jb.Job.objects.filter(top_lvl_job__in=entry.jobs).update(
+            customer_po=customer_po(order),
+            last_updated=now,
+        )
+        logger.info('Updated sales order %s', entry.sales_order)
+    for i in entry.changed_items(order):
+        order_item = order.order_items[i]
+        notes = item_notes(order_item)
+        so_details = jb.SoDetail.objects.filter(
+            sales_order=entry.sales_order, so_line='{:03d}'.format(i + 1))
+        so_details.update(
+            unit_price=order_item.unit_price.dollars,
+            unit_cost=order_item.unit_price.dollars,
+            total_price=order_item.total_price.dollars,
+            order_qty=order_item.quantity,
+            promised_date=order_item.ships_on_dt,
+            note_text=notes,
+            last_updated=now,
+        )
+        deliveries = jb.Delivery.objects.filter(so_detail__in=so_details)
+        if deliveries.filter(shipped_quantity__gt=0).exists():
+            logger.warning('Order item %d of sales order %s has started '
+                           'shipping; its deliveries were not updated', i,
+                           entry.sales_order)
+        else:
+            deliveries.update(
+                requested_date=order_item.ships_on_dt,
+                promised_date=order_item.ships_on_dt,
+                promised_quantity=order_item.quantity,
+                remaining_quantity=order_item.quantity,
+                comment=notes,
+                last_updated=now,
+            )
+        jb.Job.objects.filter(top_lvl_job=entry.jobs[i]).update(
+            order_quantity=order_item.quantity,
+            customer_po=customer_po(order),
+            lead_days=order_item.lead_days,
+            note_text=notes,
+            last_updated=now,
+        )
+        jb.Job.objects.filter(job=entry.jobs[i]).update(
+            unit_price=order_item.unit_price.dollars,
+            total_price=order_item.unit_price.dollars * order_item.quantity,
+        )
+        logger.info('Updated order item %d, job %s', i, entry.jobs[i])
+
+
+def _import_header(order: Order, timer: PhaseTimer,
+                   allocator: AutoNumberAllocator, writer: RowWriter,
+                   assemblies, materials):
+    """Match the customer and build the sales order header and its links,
+    handing them to writer. Returns the OrderContext the order's items are
+    built from, with the assemblies and materials resolved beforehand."""
     paperless_user = common.JOBBOSS_CONFIG.paperless_user \
         if common.JOBBOSS_CONFIG.paperless_user else None
     sales_code = common.JOBBOSS_CONFIG.sales_code
     import_material = common.JOBBOSS_CONFIG.import_material
-    default_location = common.JOBBOSS_CONFIG.default_location \
-        if common.JOBBOSS_CONFIG.default_location else None
     import_operations = common.JOBBOSS_CONFIG.import_operations
+    routing_plan = get_routing_plan() if import_operations else None
 
-    logger.info('Processing order {}'.format(order.number))
+    logger.info('Processing order %s', order.number)
+    timer.switch('customer')
     # get customer, bill to info, ship to info
-    if order.customer.company:
-        business_name = order.customer.company.business_name
-        code = order.customer.company.erp_code
-    else:
-        business_name = '{}, {}'.format(order.customer.last_name,
-                                        order.customer.first_name)
-        code = None
-    customer: jb.Customer = get_or_create_customer(business_name, code)
-    bill_name = '{} {}'.format(order.billing_info.first_name if order.billing_info is not None else order.customer.first_name,
-                               order.billing_info.last_name if order.billing_info is not None else order.customer.last_name)
-    contact: jb.Contact = get_or_create_contact(customer, bill_name)
-    if order.billing_info:
-        bill_to: jb.Address = get_or_create_address(
-            customer,
-            attr.asdict(order.billing_info),
-            is_shipping=False
-        )
-    else:
-        bill_to: jb.Address = get_default_billing_address(customer)
-    contact.address = bill_to.address
-    contact.save()
-    if order.shipping_info:
-        ship_to: jb.Address = get_or_create_address(
-            customer,
-            attr.asdict(order.shipping_info),
-            is_shipping=True
-        )
-    else:
-        ship_to: jb.Address = get_default_shipping_address(customer)
+    customer, customer_keys = resolve_customer(order)
 
     now = datetime.datetime.now()
     today = now.replace(hour=0, minute=0, second=0, microsecond=0)
 
-    ship_str = order.shipping_option.summary(
-        order.ships_on_dt, order.payment_details.payment_type) if order.shipping_option is not None else ''
+    ship_str = shipping_summary(order)
 
     terms = order.payment_details.payment_terms.upper() \
                 if order.payment_details.payment_type == 'purchase_order' \
@@ -73,21 +431,15 @@ def process_order(order: Order):
     if order.payment_details.payment_type == 'purchase_order' and \
             customer.terms:
         terms = customer.terms
-    notes = 'PP Quote #{}'.format(order.quote_number)
-    if order.private_notes:
-        notes += '\r\n\r\n{}'.format(order.private_notes)
-    commission_pct = 0
-    employee = None
-    if customer.sales_rep:
-        qs = jb.Employee.objects.filter(employee=customer.sales_rep)
-        employee = qs.first()
-        if employee:
-            commission_pct = employee.commission_pct
+    notes = order_notes(order)
+    employee = get_sales_rep(customer)
+    commission_pct = employee.commission_pct if employee else 0
 
+    timer.switch('so_header')
     so_header = jb.SoHeader(
         customer=customer.customer,
-        ship_to=ship_to.address,
-        contact=contact.contact,
+        ship_to=customer_keys.ship_to,
+        contact=customer_keys.contact,
         order_taken_by=paperless_user,
         ship_via=customer.ship_via,
         terms=terms,
@@ -95,7 +447,7 @@ def process_order(order: Order):
         sales_tax_rate=0,
         order_date=today,
         promised_date=order.ships_on_dt,
-        customer_po=order.payment_details.purchase_order_number[:20] if order.payment_details.purchase_order_number is not None else None,
+        customer_po=customer_po(order),
         status='Open',
         total_price=order.payment_details.total_price.dollars,
         currency_conv_rate=1,
@@ -109,8 +461,9 @@ def process_order(order: Order):
         prepaid_tax_amount=0,
         sales_rep=customer.sales_rep,
     )
-    so_header.save_with_autonumber()
-    logger.info('Created sales order {}'.format(so_header.sales_order))
+    allocator.assign(so_header)
+    writer.insert(so_header)
+    logger.info('Created sales order %s', so_header.sales_order)
 
     # create links to quote and order
     order_link = jb.Attachment(
@@ -123,7 +476,7 @@ def process_order(order: Order):
         last_updated=now,
         attach_type='Link'
     )
-    order_link.save_with_autonumber()
+    writer.add(allocator.assign(order_link))
 
     quote_link = jb.Attachment(
         owner_type='SOHeader',
@@ -135,573 +488,370 @@ def process_order(order: Order):
         last_updated=now,
         attach_type='Link'
     )
-    quote_link.save_with_autonumber()
-
-    for i, order_item in enumerate(order.order_items):
-        logger.debug('Starting order item {}'.format(i))
-        top_level_job = None
-        top_level_uuid = None
-        suffix = AssemblySuffixCounter()
-        comp_uuid = {}  # component ID -> JB object ID
-        comp_job = {}  # component ID -> JB job instance
-
-        # create jobs for each mfg component and assembly
-        for assm_comp in order_item.iterate_assembly():
-            comp: OrderComponent = assm_comp.component
-            # skip hardware, add those components later
-            if comp.is_hardware:
-                continue
-            if comp.description:
-                if len(comp.description) <= 30:
-                    desc = comp.description
-                    ext_desc = None
-                else:
-                    desc = comp.description[0:30]
-                    ext_desc = comp.description[30:]
-            else:
-                desc = None
-                ext_desc = None
-
-            # get or create material master
-            if not comp.part_number:
-                material_name = None
-            elif import_material:
-                material = get_material(comp.part_number)
-                if material:
-                    logger.info('Found matching material')
-                    material_name = material.material
-                else:
-                    logger.info('Creating Material {}'.format(
-                        comp.part_number))
-                    material_name = comp.part_number
-
-                    # calculate the standard cost as the sum of all operations
-                    cost = 0
-                    for op in chain(comp.material_operations, comp.shop_operations):
-                        cost += op.cost.dollars
-                    if order_item.quantity:
-                        cost = cost / order_item.quantity
-                    material = jb.Material.objects.create(
-                        material=comp.part_number,
-                        description=desc,
-                        ext_description=ext_desc,
-                        sales_code=sales_code,
-                        rev=comp.revision,
-                        location_id=default_location,
-                        type='F',
-                        status='Active',
-                        pick_buy_indicator='P',
-                        stocked_uofm='ea',
-                        purchase_uofm='ea',
-                        cost_uofm='ea',
-                        price_uofm='ea',
-                        selling_price=order_item.unit_price.dollars,
-                        standard_cost=cost,
-                        reorder_qty=0,
-                        lead_days=0,
-                        uofm_conv_factor=1,
-                        lot_trace=False,
-                        rd_whole_unit=False,
-                        make_buy='M',
-                        use_price_breaks=True,
-                        last_updated=datetime.datetime.utcnow(),
-                        taxable=False,
-                        affects_schedule=True,
-                        tooling=False,
-                        isserialized=False,
-                        objectid=uuid.uuid4()
-                    )
-                    material_name = material.material
-            else:
-                material_name = comp.part_number
-
-            notes = []
-            if order_item.public_notes:
-                notes.append(order_item.public_notes)
-            if order_item.private_notes:
-                notes.append(order_item.private_notes)
-            extras = comp.make_quantity - (order_item.quantity * comp.innate_quantity)
-            job = jb.Job(
-                sales_rep=employee,
-                customer=customer,
-                ship_to=ship_to.address,
-                contact=contact.contact,
-                terms=terms,
-                sales_code=sales_code,
-                type='Assembly' if len(comp.child_ids) else 'Regular',
-                order_date=today,
-                status='Active',
-                status_date=today,
-                part_number=material_name,
-                rev=comp.revision,
-                description=desc,
-                ext_description=ext_desc,
-                drawing=comp.part_number,
-                build_to_stock=True,
-                order_quantity=order_item.quantity,
-                extra_quantity=extras,
-                pick_quantity=0,
-                make_quantity=comp.make_quantity,
-                split_quantity=0,
-                completed_quantity=0,
-                shipped_quantity=0,
-                fg_transfer_qty=0,
-                returned_quantity=0,
-                in_production_quantity=0,
-                assembly_level=0,
-                certs_required=False,
-                time_and_materials=False,
-                open_operations=0,
-                scrap_pct=extras / comp.make_quantity * 100,
-                est_scrap_qty=extras,
-                est_rem_hrs=0,
-                est_total_hrs=0,
-                est_labor=0,
-                est_material=0,
-                est_service=0,
-                est_labor_burden=0,
-                est_machine_burden=0,
-                est_ga_burden=0,
-                act_revenue=0,
-                act_scrap_quantity=0,
-                act_total_hrs=0,
-                act_labor=0,
-                act_material=0,
-                act_service=0,
-                act_labor_burden=0,
-                act_machine_burden=0,
-                act_ga_burden=0,
-                priority=5,
-                unit_price=order_item.unit_price.dollars if comp.is_root_component else 0,
-                total_price=order_item.unit_price.dollars * order_item.quantity if comp.is_root_component else 0,
-                price_uofm='ea',
-                currency_conv_rate=1,
-                trade_currency=1,
-                fixed_rate=True,
-                trade_date=today,
-                commission_pct=commission_pct,
-                customer_po=order.payment_details.purchase_order_number[:20] if order.payment_details.purchase_order_number is not None else None,
-                customer_po_ln=None,
-                quantity_per=1,
-                profit_pct=0,
-                labor_markup_pct=0,
-                mat_markup_pct=0,
-                serv_markup_pct=0,
-                labor_burden_markup_pct=0,
-                machine_burden_markup_pct=0,
-                ga_burden_markup_pct=0,
-                lead_days=order_item.lead_days,
-                profit_markup='M',
-                prepaid_amt=0,
-                split_to_job=False,
-                note_text='\n\n'.join(notes),
+    writer.add(allocator.assign(quote_link))
+
+    # columns shared by all rows of a type in this order
+    job_template = templates.JOB.derive(
+        sales_rep=employee,
+        customer=customer,
+        ship_to=customer_keys.ship_to,
+        contact=customer_keys.contact,
+        terms=terms,
+        sales_code=sales_code,
+        order_date=today,
+        status_date=today,
+        trade_date=today,
+        commission_pct=commission_pct,
+        customer_po=customer_po(order),
+        last_updated=now,
+        ship_via=customer.ship_via,
+    )
+    operation_template = templates.JOB_OPERATION.derive(last_updated=now)
+    material_template = templates.MATERIAL_REQ.derive(
+        trade_date=today, last_updated=now)
+    hardware_template = templates.HARDWARE_REQ.derive(
+        trade_date=today, last_updated=now)
+
+    return OrderContext(
+        order=order,
+        so_header=so_header,
+        customer_keys=customer_keys,
+        assemblies=assemblies,
+        materials=materials,
+        job_template=job_template,
+        operation_template=operation_template,
+        material_template=material_template,
+        hardware_template=hardware_template,
+        import_operations=import_operations,
+        routing_plan=routing_plan,
+        sales_code=sales_code,
+        import_material=import_material,
+        commission_pct=commission_pct,
+        now=now,
+        today=today,
+    )
+
+
+def _import_item(ctx: OrderContext, i, order_item, assembly: AssemblyIndex,
+                 timer: PhaseTimer, allocator: AutoNumberAllocator,
+                 writer: RowWriter):
+    """Build the jobs, routing, material requirements, sales order line and
+    delivery of order item i and hand them to writer. Returns the item's
+    top-level job."""
+    order = ctx.order
+    so_header = ctx.so_header
+    customer_keys = ctx.customer_keys
+    materials = ctx.materials
+    sales_code = ctx.sales_code
+    import_material = ctx.import_material
+    commission_pct = ctx.commission_pct
+    now = ctx.now
+    today = ctx.today
+    logger.debug('Starting order item %d', i)
+    item_jobs = item_ops = item_hardware = 0
+    item_delivery = None
+    top_level_job = None
+    top_level_uuid = None
+    comp_uuid = {}  # component ID -> JB object ID
+    comp_job = {}  # component ID -> JB job instance
+
+    # create jobs for each mfg component and assembly
+    for assm_comp, suffix in assembly.manufactured:
+        timer.switch('jobs')
+        comp: OrderComponent = assm_comp.component
+        desc, ext_desc = split_description(comp.description)
+
+        # material masters were found or created up front
+        if not comp.part_number:
+            material_name = None
+        elif import_material:
+            material = materials[material_key(comp.part_number)]
+            material_name = material.material
+        else:
+            material_name = comp.part_number
+
+        notes = item_notes(order_item)
+        extras = comp.make_quantity - (order_item.quantity * comp.innate_quantity)
+        job = ctx.job_template.build(
+            type='Assembly' if len(comp.child_ids) else 'Regular',
+            part_number=material_name,
+            rev=comp.revision,
+            description=desc,
+            ext_description=ext_desc,
+            drawing=comp.part_number,
+            order_quantity=order_item.quantity,
+            extra_quantity=extras,
+            make_quantity=comp.make_quantity,
+            scrap_pct=extras / comp.make_quantity * 100,
+            est_scrap_qty=extras,
+            unit_price=order_item.unit_price.dollars if comp.is_root_component else 0,
+            total_price=order_item.unit_price.dollars * order_item.quantity if comp.is_root_component else 0,
+            lead_days=order_item.lead_days,
+            note_text=notes,
+            objectid=str(uuid.uuid4()),
+            top_lvl_job=top_level_job,
+        )
+        if comp.is_root_component:
+            allocator.assign(job)
+            top_level_job = job.job
+            top_level_uuid = job.objectid
+            job.top_lvl_job = top_level_job
+            writer.insert(job)
+        else:
+            job.job = top_level_job + suffix
+            job.top_lvl_job = top_level_job
+            writer.add(job)
+        comp_uuid[comp.id] = job.objectid
+        comp_job[comp.id] = job
+        item_jobs += 1
+        logger.debug('Created job %s', job.job)
+
+        # link the assembly
+        if not comp.is_root_component:
+            writer.add(jb.BillOfJobs(
+                parent_job=comp_job[assm_comp.parent.id],
+                component_job=job,
+                relationship_type='Component',
+                relationship_qty=comp.innate_quantity,
+                manual_link=False,
                 last_updated=now,
-                order_unit='ea',
-                price_unit_conv=1,
-                source='System',
-                plan_modified=False,
+                root_job=top_level_job,
                 objectid=str(uuid.uuid4()),
-                prepaid_tax_amount=0,
-                prepaid_trade_amt=0,
-                commissionincluded=False,
-                ship_via=customer.ship_via,
-                top_lvl_job=top_level_job,
+                root_job_oid=top_level_uuid,
+                parent_job_oid=comp_uuid[assm_comp.parent.id],
+                component_job_oid=job.objectid
+            ))
+
+        # create links to quote and order
+        if comp.is_root_component:
+            order_link = jb.Attachment(
+                owner_type='Job',
+                owner_id=job.job,
+                attach_path='https://app.paperlessparts.com/orders/edit/{}'.format(
+                    order.number),
+                description='PP Order #{}'.format(order.number),
+                print_attachment=False,
+                last_updated=now,
+                attach_type='Link'
             )
-            if comp.is_root_component:
-                job.save_with_autonumber()
-                top_level_job = job.job
-                top_level_uuid = job.objectid
-                suffix.get_suffix(0, 0, 1)
-            else:
-                job.job = top_level_job + suffix.get_suffix(
-                    assm_comp.level,
-                    assm_comp.level_index,
-                    assm_comp.level_count
-                )
-            job.top_lvl_job = top_level_job
-            job.save()
-            comp_uuid[comp.id] = job.objectid
-            comp_job[comp.id] = job
-            logger.info('Created job {}'.format(job.job))
-
-            # link the assembly
-            if not comp.is_root_component:
-                jb.BillOfJobs.objects.create(
-                    parent_job=comp_job[assm_comp.parent.id],
-                    component_job=job,
-                    relationship_type='Component',
-                    relationship_qty=comp.innate_quantity,
-                    manual_link=False,
-                    last_updated=now,
-                    root_job=top_level_job,
-                    objectid=str(uuid.uuid4()),
-                    root_job_oid=top_level_uuid,
-                    parent_job_oid=comp_uuid[assm_comp.parent.id],
-                    component_job_oid=job.objectid
-                )
-
-            # create links to quote and order
-            if comp.is_root_component:
-                order_link = jb.Attachment(
-                    owner_type='Job',
-                    owner_id=job.job,
-                    attach_path='https://app.paperlessparts.com/orders/edit/{}'.format(
-                        order.number),
-                    description='PP Order #{}'.format(order.number),
-                    print_attachment=False,
-                    last_updated=now,
-                    attach_type='Link'
-                )
-                order_link.save_with_autonumber()
-
-                quote_link = jb.Attachment(
-                    owner_type='Job',
-                    owner_id=job.job,
-                    attach_path='https://app.paperlessparts.com/quotes/edit/{}'.format(
-                        order.quote_number),
-                    description='PP Quote #{}'.format(order.quote_number),
-                    print_attachment=False,
-                    last_updated=now,
-                    attach_type='Link'
-                )
-                quote_link.save_with_autonumber()
-
-            if comp.material:
-                mat_name = comp.material.name.upper()
-            else:
-                mat_name = ''
-            mat = jb.MaterialReq(
-                job=job,
-                description=mat_name[0:30],
-                pick_buy_indicator='B',
-                type='M',
-                status='O',
-                quantity_per_basis='I',
-                quantity_per=0,
-                uofm='ea',
+            writer.add(allocator.assign(order_link))
+
+            quote_link = jb.Attachment(
+                owner_type='Job',
+                owner_id=job.job,
+                attach_path='https://app.paperlessparts.com/quotes/edit/{}'.format(
+                    order.quote_number),
+                description='PP Quote #{}'.format(order.quote_number),
+                print_attachment=False,
+                last_updated=now,
+                attach_type='Link'
+            )
+            writer.add(allocator.assign(quote_link))
+
+        if comp.material:
+            mat_name = comp.material.name.upper()
+        else:
+            mat_name = ''
+        mat = ctx.material_template.build(
+            job=job,
+            description=mat_name[0:30],
+            objectid=uuid.uuid4(),
+            job_oid=job.objectid,
+        )
+        writer.add(mat)
+
+        if comp.is_root_component:
+            so_detail = jb.SoDetail(
+                sales_order=so_header,
+                so_line='{:03d}'.format(i + 1),
+                line=None,
+                material=material_name,
+                ship_to=customer_keys.ship_to,
+                drop_ship=False,
+                quote=None,
+                job=job.job,
+                status='Open',
+                make_buy='M',
+                unit_price=order_item.unit_price.dollars,
+                discount_pct=0,
+                price_uofm='ea',
+                total_price=order_item.total_price.dollars,
                 deferred_qty=0,
-                est_qty=0,
-                est_unit_cost=0,
-                est_addl_cost=0,
-                est_total_cost=0,
-                act_qty=0,
-                act_unit_cost=0,
-                act_addl_cost=0,
-                act_total_cost=0,
-                part_length=0,
-                part_width=0,
-                bar_end=0,
-                cutoff=0,
-                facing=0,
-                bar_length=0,
-                lead_days=0,
-                currency_conv_rate=1,
-                trade_currency=1,
-                fixed_rate=True,
-                trade_date=today,
+                prepaid_amt=0,
+                unit_cost=order_item.unit_price.dollars,
+                order_qty=order_item.quantity,
+                stock_uofm='ea',
+                backorder_qty=0,
+                picked_qty=0,
+                shipped_qty=0,
+                returned_qty=0,
                 certs_required=False,
-                manual_link=False,
+                taxable=False,
+                commissionable=bool(commission_pct),
+                commission_pct=commission_pct,
+                sales_code=sales_code,
+                note_text=notes,
+                promised_date=order_item.ships_on_dt,
                 last_updated=now,
+                description=desc,
+                ext_description=ext_desc,
+                price_unit_conv=1,
+                rev=comp.revision,
                 cost_uofm='ea',
                 cost_unit_conv=1,
-                quantity_multiplier=1,
                 partial_res=False,
+                prepaid_trade_amt=0,
                 objectid=uuid.uuid4(),
-                job_oid=job.objectid,
-                affects_schedule=False,
-                rounded=True
+                commissionincluded=False
             )
-            mat.save()
+            writer.insert(so_detail)
 
+            delivery = jb.Delivery(
+                so_detail=so_detail.so_detail,
+                requested_date=order_item.ships_on_dt,
+                promised_date=order_item.ships_on_dt,
+                promised_quantity=order_item.quantity,
+                shipped_quantity=0,
+                remaining_quantity=order_item.quantity,
+                returned_quantity=0,
+                ncp_quantity=0,
+                comment=notes,
+                last_updated=now,
+                objectid=str(uuid.uuid4()),
+            )
+            writer.add(allocator.assign(delivery))
+            item_delivery = delivery.delivery
+
+        # now insert routing for operations
+        timer.switch('routing')
+        if ctx.import_operations:
+            operations_list = comp.shop_operations
             if comp.is_root_component:
-                so_detail = jb.SoDetail(
-                    sales_order=so_header,
-                    so_line='{:03d}'.format(i + 1),
-                    line=None,
-                    material=material_name,
-                    ship_to=ship_to.address,
-                    drop_ship=False,
-                    quote=None,
-                    job=job.job,
-                    status='Open',
-                    make_buy='M',
-                    unit_price=order_item.unit_price.dollars,
-                    discount_pct=0,
-                    price_uofm='ea',
-                    total_price=order_item.total_price.dollars,
-                    deferred_qty=0,
-                    prepaid_amt=0,
-                    unit_cost=order_item.unit_price.dollars,
-                    order_qty=order_item.quantity,
-                    stock_uofm='ea',
-                    backorder_qty=0,
-                    picked_qty=0,
-                    shipped_qty=0,
-                    returned_qty=0,
-                    certs_required=False,
-                    taxable=False,
-                    commissionable=bool(commission_pct),
-                    commission_pct=commission_pct,
-                    sales_code=sales_code,
-                    note_text='\n\n'.join(notes),
-                    promised_date=order_item.ships_on_dt,
-                    last_updated=now,
-                    description=desc,
-                    ext_description=ext_desc,
-                    price_unit_conv=1,
-                    rev=comp.revision,
-                    cost_uofm='ea',
-                    cost_unit_conv=1,
-                    partial_res=False,
-                    prepaid_trade_amt=0,
-                    objectid=uuid.uuid4(),
-                    commissionincluded=False
-                )
-                so_detail.save()
-                so_detail.refresh_from_db()
-
-                delivery = jb.Delivery(
-                    so_detail=so_detail.so_detail,
-                    requested_date=order_item.ships_on_dt,
-                    promised_date=order_item.ships_on_dt,
-                    promised_quantity=order_item.quantity,
-                    shipped_quantity=0,
-                    remaining_quantity=order_item.quantity,
-                    returned_quantity=0,
-                    ncp_quantity=0,
-                    comment='\n\n'.join(notes),
-                    last_updated=now,
-                    objectid=str(uuid.uuid4()),
-                )
-                delivery.save_with_autonumber()
-                logger.info('Created delivery {}'.format(delivery.delivery))
-
-            # now insert routing for operations
-            if import_operations:
-                operations_list = comp.shop_operations
-                if comp.is_root_component:
-                    operations_list = operations_list + order_item.ordered_add_ons
-                j = -1
-                for op in operations_list:
-                    runtime = 0
-                    setup_time = 0
-                    notes = None
-                    if isinstance(op, Operation):
-                        runtime = op.runtime if op.runtime is not None else 0
-                        setup_time = op.setup_time if op.setup_time is not None else 0
-                        notes = op.notes
-                    routing_lines = list(generate_routing_lines(op.name))
-                    for k, routing_line in enumerate(routing_lines):
-                        j += 1
-                        logger.debug('Creating operation {}'.format(j))
-                        job_op = jb.JobOperation(
-                            job=job,
-                            sequence=j,
-                            description=op.name[0:25] if op.name else op.name,
-                            priority=5,
-                            run_method='Min/Part',
-                            run=runtime * 60,
-                            est_run_per_part=runtime,
-                            efficiency_pct=100,
-                            attended_pct=100,
-                            queue_hrs=0,
-                            est_total_hrs=comp.make_quantity * runtime + setup_time,
-                            est_setup_hrs=setup_time,
-                            est_run_hrs=runtime * comp.make_quantity,
-                            est_setup_labor=0,
-                            est_run_labor=0,
-                            est_labor_burden=0,
-                            est_machine_burden=0,
-                            est_ga_burden=0,
-                            est_required_qty=comp.make_quantity,
-                            est_unit_cost=0,
-                            est_addl_cost=0,
-                            est_total_cost=0,
-                            deferred_qty=comp.make_quantity,
-                            act_setup_hrs=0,
-                            act_run_hrs=0,
-                            act_run_qty=0,
-                            act_scrap_qty=0,
-                            act_setup_labor=0,
-                            act_run_labor=0,
-                            act_labor_burden=0,
-                            act_machine_burden=0,
-                            act_ga_burden=0,
-                            act_unit_cost=0,
-                            act_addl_cost=0,
-                            act_total_cost=0,
-                            setup_pct_complete=0,
-                            run_pct_complete=0,
-                            rem_run_hrs=runtime * comp.make_quantity,
-                            rem_setup_hrs=setup_time,
-                            rem_total_hrs=comp.make_quantity * runtime + setup_time,
-                            overlap=0,
-                            overlap_qty=0,
-                            est_ovl_hrs=0,
-                            lead_days=0,
-                            schedule_exception_old=False,
-                            status='O',
-                            minimum_chg_amt=0,
-                            cost_unit_conv=0,
-                            currency_conv_rate=1,
-                            fixed_rate=True,
-                            rwk_quantity=0,
-                            rwk_setup_hrs=0,
-                            rwk_run_hrs=0,
-                            rwk_setup_labor=0,
-                            rwk_run_labor=0,
-                            rwk_labor_burden=0,
-                            rwk_machine_burden=0,
-                            rwk_ga_burden=0,
-                            rwk_scrap_qty=0,
-                            note_text=notes,
-                            last_updated=now,
-                            act_run_labor_hrs=0,
-                            setup_qty=0,
-                            run_qty=0,
-                            rwk_run_labor_hrs=0,
-                            rwk_setup_qty=0,
-                            rwk_run_qty=0,
-                            act_setup_labor_hrs=0,
-                            rwk_setup_labor_hrs=0,
-                            objectid=str(uuid.uuid4()),
-                            job_oid=job.objectid,
-                            sched_resources=1,
-                            lag_hours=0,
-                            manual_start_lock=False,
-                            manual_stop_lock=False,
-                            priority_zero_lock=False,
-                            firm_zone_lock=False,
-                            sb_runmethod=None,
-                        )
-                        if not routing_line.is_inside:
-                            # outside service
-                            job_op.inside_oper = False
-                            job_op.vendor = routing_line.vendor_instance
-                            job_op.wc_vendor = routing_line.vendor_instance.vendor
-                            job_op.operation_service = routing_line.service[0:10] \
-                                if routing_line.service else routing_line.service
-                            job_op.cost_unit = 'ea'
-                            job_op.cost_unit_conv = 1
-                            job_op.trade_currency = 1
-                            job_op.trade_date = today
-                            if comp.deliver_quantity:
-                                job_op.est_unit_cost = safe_round(
-                                    op.cost.dollars / comp.deliver_quantity)
-                            job_op.est_total_cost = safe_round(op.cost.dollars)
-                            job_op.act_run_qty = comp.make_quantity
-                        else:
-                            # inside operation
-                            job_op.inside_oper = True
-                            job_op.work_center = routing_line.work_center_instance
-                            job_op.wc_vendor = routing_line.work_center_instance.work_center
-                            if routing_line.has_operation:
-                                job_op.operation_service = routing_line.operation[0:10]
-                                job_op.note_text = routing_line.operation_instance.note_text
-                            job_op.workcenter_oid = routing_line.work_center_instance.objectid
-                            job_op.queue_hrs = routing_line.work_center_instance.queue_hrs
-                        try:
-                            job_op.save()
-                        except:
-                            logger.error('Could not save operation')
-                            logger.error(job_op.__dict__)
-                            raise
-                        logger.info('Saved operation {} {} {}'.format(
-                            j, job_op.work_center, job_op.vendor))
-
-        # add hardware items as MaterialReqs
-        comp: OrderComponent
-        for comp in order_item.components:
-            if not comp.is_hardware:
-                continue
-            material = get_material(comp.part_number)
-            if material:
-                logger.info('Found matching hardware material')
-                material_name = material.material
-            else:
-                if import_material:
-                    logger.info('Creating hardware Material {}'.format(
-                        comp.part_number))
-                    material = jb.Material.objects.create(
-                        material=comp.part_number,
-                        description=comp.description[0:30] if comp.description else None,
-                        sales_code=sales_code,
-                        rev=comp.revision,
-                        location_id=default_location,
-                        type='H',
-                        status='Active',
-                        pick_buy_indicator='B',
-                        stocked_uofm='ea',
-                        purchase_uofm='ea',
-                        cost_uofm='ea',
-                        price_uofm='ea',
-                        standard_cost=0.0,
-                        reorder_qty=0,
-                        lead_days=0,
-                        uofm_conv_factor=1,
-                        lot_trace=False,
-                        rd_whole_unit=False,
-                        make_buy='B',
-                        use_price_breaks=True,
-                        last_updated=datetime.datetime.utcnow(),
-                        taxable=False,
-                        affects_schedule=False,
-                        tooling=False,
-                        isserialized=False,
-                        objectid=uuid.uuid4()
+                operations_list = operations_list + order_item.ordered_add_ons
+            j = -1
+            for op in operations_list:
+                runtime = 0
+                setup_time = 0
+                notes = None
+                if isinstance(op, Operation):
+                    runtime = op.runtime if op.runtime is not None else 0
+                    setup_time = op.setup_time if op.setup_time is not None else 0
+                    notes = op.notes
+                for routing_line in ctx.routing_plan.lines(op.name):
+                    j += 1
+                    job_op = ctx.operation_template.build(
+                        job=job,
+                        sequence=j,
+                        description=op.name[0:25] if op.name else op.name,
+                        run=runtime * 60,
+                        est_run_per_part=runtime,
+                        est_total_hrs=comp.make_quantity * runtime + setup_time,
+                        est_setup_hrs=setup_time,
+                        est_run_hrs=runtime * comp.make_quantity,
+                        est_required_qty=comp.make_quantity,
+                        deferred_qty=comp.make_quantity,
+                        rem_run_hrs=runtime * comp.make_quantity,
+                        rem_setup_hrs=setup_time,
+                        rem_total_hrs=comp.make_quantity * runtime + setup_time,
+                        note_text=notes,
+                        objectid=str(uuid.uuid4()),
+                        job_oid=job.objectid,
                     )
-                    material_name = material.material
-                else:
-                    material_name = comp.part_number
-                    logger.info('No hardware material for {}'.format(
-                        comp.part_number))
-
-            for parent_id in comp.parent_ids:
-                job = comp_job[parent_id]
-                qty_per = None
-                parent = order_item.get_component(parent_id)
-                for child in parent.children:
-                    if child.child_id == comp.id:
-                        qty_per = child.quantity
-                        break
-                jb.MaterialReq.objects.create(
-                    job=job,
-                    material=material_name,
-                    description=comp.description[0:30] if comp.description else material_name,
-                    pick_buy_indicator='B',
-                    type='H',
-                    status='O',
-                    quantity_per_basis='I',
-                    quantity_per=qty_per,
-                    uofm='ea',
-                    deferred_qty=0,
-                    est_qty=comp.make_quantity,
-                    est_unit_cost=0,
-                    est_addl_cost=0,
-                    est_total_cost=0,
-                    act_qty=0,
-                    act_unit_cost=0,
-                    act_total_cost=0,
-                    part_length=0,
-                    part_width=0,
-                    bar_end=0,
-                    facing=0,
-                    bar_length=0,
-                    lead_days=0,
-                    currency_conv_rate=1,
-                    trade_currency=1,
-                    fixed_rate=1,
-                    trade_date=today,
-                    certs_required=0,
-                    manual_link=1,
-                    last_updated=now,
-                    cost_uofm='ea',
-                    cost_unit_conv=1,
-                    quantity_multiplier=1,
-                    partial_res=0,
-                    objectid=str(uuid.uuid4()),
-                    job_oid=job.objectid,
-                    affects_schedule=0,
-                    material_oid=material.objectid if material else None,
-                    rounded=1,
-                )
+                    if not routing_line.is_inside:
+                        # outside service
+                        job_op.inside_oper = False
+                        job_op.vendor = routing_line.vendor
+                        job_op.wc_vendor = routing_line.wc_vendor
+                        job_op.operation_service = routing_line.operation_service
+                        job_op.cost_unit = 'ea'
+                        job_op.cost_unit_conv = 1
+                        job_op.trade_currency = 1
+                        job_op.trade_date = today
+                        if comp.deliver_quantity:
+                            job_op.est_unit_cost = safe_round(
+                                op.cost.dollars / comp.deliver_quantity)
+                        job_op.est_total_cost = safe_round(op.cost.dollars)
+                        job_op.act_run_qty = comp.make_quantity
+                    else:
+                        # inside operation
+                        job_op.inside_oper = True
+                        job_op.work_center = routing_line.work_center
+                        job_op.wc_vendor = routing_line.wc_vendor
+                        if routing_line.has_operation:
+                            job_op.operation_service = routing_line.operation_service
+                            job_op.note_text = routing_line.operation_note_text
+                        job_op.workcenter_oid = routing_line.workcenter_oid
+                        job_op.queue_hrs = routing_line.queue_hrs
+                    try:
+                        writer.add(job_op)
+                    except:
+                        logger.error('Could not save operation %s',
+                                     job_op.__dict__)
+                        raise
+                    item_ops += 1
+                    logger.debug('Added operation %d %s', j,
+                                 job_op.wc_vendor)
+
+    # add hardware items as MaterialReqs
+    timer.switch('hardware')
+    comp: OrderComponent
+    for comp, placements in assembly.hardware:
+        material = materials.get(material_key(comp.part_number)) \
+            if comp.part_number else None
+        if material:
+            material_name = material.material
+        else:
+            material_name = comp.part_number
+
+        for parent_id, qty_per in placements:
+            job = comp_job[parent_id]
+            writer.add(ctx.hardware_template.build(
+                job=job,
+                material=material_name,
+                description=comp.description[0:30] if comp.description else material_name,
+                quantity_per=qty_per,
+                est_qty=comp.make_quantity,
+                objectid=str(uuid.uuid4()),
+                job_oid=job.objectid,
+                material_oid=material.objectid if material else None,
+            ))
+            item_hardware += 1
+    logger.info('Order item %d: job %s, delivery %s, %d jobs, %d '
+                'operations, %d hardware requirements', i,
+                top_level_job, item_delivery, item_jobs, item_ops,
+                item_hardware)
+    return top_level_job
+
+
+@contextmanager
+def _item_savepoint(order: Order, i):
+    """Write order item i within a savepoint, rolled back if it fails."""
+    savepoint = transaction.savepoint()
+    try:
+        yield
+    except:
+        transaction.savepoint_rollback(savepoint)
+        logger.error('Could not import order item %d; rolling back order '
+                     '%s', i, order.number)
+        raise
+    transaction.savepoint_commit(savepoint)
+
+
+def _import_order(order: Order, timer: PhaseTimer,
+                  allocator: AutoNumberAllocator, writer: RowWriter,
+                  assemblies, materials):
+    """Build the rows for order, with the assemblies and materials already
+    resolved, and hand them to writer, which writes them or, for a plan,
+    records them. Returns the sales order number and the
+    top-level job of each order item."""
+    ctx = _import_header(order, timer, allocator, writer, assemblies,
+                         materials)
+    jobs = []
+    for i, (order_item, assembly) in enumerate(zip(order.order_items,
+                                                   ctx.assemblies)):
+        with _item_savepoint(order, i):
+            jobs.append(_import_item(ctx, i, order_item, assembly, timer,
+                                     allocator, writer))
+    timer.switch('flush')
+    writer.flush()
+    return ctx.so_header.sales_order, jobs
@@ -0,0 +1,143 @@
+"""
+Local ledger of imported orders. For every order imported it records a
+content hash of the order and the JobBOSS sales order and top-level jobs
+created for it, so that importing the same order again is detected with one
+lookup instead of creating a duplicate sales order and job tree. Hashes of the
+order header and of each order item are kept too, so that when an order has
+changed the rows affected can be found.
+"""
+import attr
+import datetime
+import hashlib
+import json
+import sqlite3
+import threading
+import common
+from paperless.objects.orders import Order
+
+logger = common.get_logger('ledger')
+
+HASH_EXCLUDE = frozenset(('status',))
+"""Order fields that change without the order's content changing"""
+
+
+def digest(value):
+    return hashlib.sha256(json.dumps(
+        value, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def _asdict(obj, exclude=()):
+    return attr.asdict(obj, filter=lambda a, v: a.name not in HASH_EXCLUDE
+                       and a.name not in exclude)
+
+
+def header_hash(order: Order):
+    return digest(_asdict(order, exclude=('order_items',)))
+
+
+def item_hashes(order: Order):
+    """Return [commercial hash, components hash] of each order item. The
+    commercial hash covers quantities, prices, dates and notes; the
+    components hash covers the parts, assembly structure and operations."""
+    return [
+        [digest(_asdict(order_item, exclude=('components',))),
+         digest([_asdict(comp) for comp in order_item.components])]
+        for order_item in order.order_items
+    ]
+
+
+def order_hash(order: Order):
+    return digest(_asdict(order))
+
+
+@attr.s(frozen=True)
+class LedgerEntry:
+    order_number = attr.ib()
+    content_hash = attr.ib()
+    header_hash = attr.ib()
+    item_hashes = attr.ib()  # as returned by item_hashes()
+    sales_order = attr.ib()
+    jobs = attr.ib()  # top-level job of each order item
+    imported_at = attr.ib()
+
+    @classmethod
+    def for_order(cls, order: Order, sales_order, jobs):
+        return cls(
+            order_number=order.number,
+            content_hash=order_hash(order),
+            header_hash=header_hash(order),
+            item_hashes=item_hashes(order),
+            sales_order=sales_order,
+            jobs=list(jobs),
+            imported_at=datetime.datetime.now().isoformat(timespec='seconds'),
+        )
+
+    def structure_changed(self, order: Order):
+        """True if items were added or removed, or the components of an item
+        changed, so that the order cannot be updated in place."""
+        hashes = item_hashes(order)
+        return len(hashes) != len(self.item_hashes) or any(
+            new[1] != old[1] for new, old in zip(hashes, self.item_hashes))
+
+    def changed_items(self, order: Order):
+        """Indexes of the order items whose commercial fields changed."""
+        return [i for i, (new, old) in
+                enumerate(zip(item_hashes(order), self.item_hashes))
+                if new[0] != old[0]]
+
+
+class Ledger:
+    """LedgerEntry for each imported order number, stored in a SQLite file
+    if a path is given or in memory otherwise."""
+
+    def __init__(self, path=None):
+        self._db = sqlite3.connect(path or ':memory:',
+                                   check_same_thread=False)
+        self._lock = threading.Lock()
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS imported_orders ('
+            'order_number INTEGER PRIMARY KEY, content_hash TEXT, '
+            'header_hash TEXT, item_hashes TEXT, sales_order INTEGER, '
+            'jobs TEXT, imported_at TEXT)')
+        self._db.commit()
+
+    def get(self, order_number):
+        with self._lock:
+            row = self._db.execute(
+                'SELECT order_number, content_hash, header_hash, item_hashes, '
+                'sales_order, jobs, imported_at FROM imported_orders '
+                'WHERE order_number = ?', (order_number,)).fetchone()
+        if row is None:
+            return None
+        row = list(row)
+        row[3] = json.loads(row[3])
+        row[5] = json.loads(row[5])
+        return LedgerEntry(*row)
+
+    def record(self, entry: LedgerEntry):
+        row = list(attr.astuple(entry, recurse=False))
+        row[3] = json.dumps(row[3])
+        row[5] = json.dumps(row[5])
+        with self._lock:
+            self._db.execute(
+                'INSERT OR REPLACE INTO imported_orders VALUES '
+                '(?, ?, ?, ?, ?, ?, ?)', row)
+            self._db.commit()
+        logger.debug('Recorded order %s as sales order %s',
+                      entry.order_number, entry.sales_order)
+
+    def forget(self, order_number):
+        with self._lock:
+            self._db.execute('DELETE FROM imported_orders '
+                             'WHERE order_number = ?', (order_number,))
+            self._db.commit()
+
+
+LEDGER = None
+
+
+def get_ledger():
+    global LEDGER
+    if LEDGER is None:
+        LEDGER = Ledger(common.JOBBOSS_CONFIG.ledger_path)
+    return LEDGER
@@ -0,0 +1,105 @@
+"""
+Checks Paperless Parts for new orders and imports them, once or, in daemon
+mode, on a schedule.
+"""
+import random
+import time
+import common
+from paperless.client import PaperlessClient
+from paperless.listeners import OrderListener
+from paperless.main import PaperlessSDK
+from backlog import get_backlog
+from routing import warm_lookup_cache, compile_routing_plan, \
+    clear_cache_if_requested
+from workers import OrderPool
+
+logger = common.get_logger('listener')
+
+
+def warm_caches():
+    if common.JOBBOSS_CONFIG.import_operations:
+        warm_lookup_cache()
+        compile_routing_plan()
+
+
+class MyOrderListener(OrderListener):
+    def __init__(self, pool: OrderPool = None, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.pool = pool
+
+    def on_event(self, resource):
+        if resource.status != 'cancelled':
+            self.pool.submit(resource)
+
+
+def connect_paperless():
+    PaperlessClient(
+        access_token=common.PAPERLESS_CONFIG.token,
+        group_slug=common.PAPERLESS_CONFIG.slug
+    )
+
+
+def poll(my_sdk: PaperlessSDK, listener: MyOrderListener):
+    """Import the orders waiting in the backlog, if backlog_path is set,
+    then check for new orders once and import them."""
+    listener.pool = OrderPool(
+        workers=common.PAPERLESS_CONFIG.workers,
+        prefetch=common.PAPERLESS_CONFIG.prefetch,
+        prefetch_max_components=common.PAPERLESS_CONFIG.prefetch_max_components,
+        backlog=get_backlog() if common.PAPERLESS_CONFIG.backlog_path
+        else None,
+        batch=common.PAPERLESS_CONFIG.backlog_batch
+    )
+    try:
+        listener.pool.resume()
+        my_sdk.run()
+    finally:
+        listener.pool.join()
+
+
+def check_db_connection():
+    """Reopen the JobBOSS connection if it has gone away since the last
+    poll."""
+    from django.db import connection
+    if connection.connection is not None and not connection.is_usable():
+        logger.warning('JobBOSS connection lost; reconnecting')
+        connection.close()
+    connection.ensure_connection()
+
+
+def main():
+    connect_paperless()
+    warm_caches()
+    my_sdk = PaperlessSDK(loop=False)
+    listener = MyOrderListener()
+    my_sdk.add_listener(listener)
+    poll(my_sdk, listener)
+
+
+def run_daemon():
+    """Stay resident, polling for new orders every poll_interval seconds
+    plus up to poll_jitter seconds. The JobBOSS connection and caches are
+    kept between polls, and config.ini is re-read when it changes."""
+    logger.info('Running connector as a daemon')
+    connect_paperless()
+    clear_cache_if_requested()  # the caches are about to be filled anyway
+    warm_caches()
+    my_sdk = PaperlessSDK(loop=False)
+    listener = MyOrderListener()
+    my_sdk.add_listener(listener)
+    while True:
+        if common.reload_config_if_changed():
+            connect_paperless()
+            warm_caches()
+        elif clear_cache_if_requested():
+            warm_caches()
+        if common.PAPERLESS_CONFIG.active:
+            try:
+                check_db_connection()
+                poll(my_sdk, listener)
+            except Exception:
+                logger.exception('Could not check for new orders')
+        else:
+            logger.debug('Inactive')
+        time.sleep(common.PAPERLESS_CONFIG.poll_interval +
+                   random.uniform(0, common.PAPERLESS_CONFIG.poll_jitter))
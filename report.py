@@ -0,0 +1,195 @@
+"""
+Packages CSV tables into a compressed report without going through a scratch
+folder or an external tar. Tables are written either into one archive
+(tar.gz, tar.bz2, tar.xz or zip), or, in incremental mode, each into its own
+compressed file as soon as it is complete, so that the tables finished
+before a failure are kept.
+"""
+import bz2
+import csv
+import gzip
+import io
+import lzma
+import os
+import shutil
+import tarfile
+import tempfile
+import threading
+import time
+import zipfile
+
+CODECS = ('gz', 'bz2', 'xz', 'zip')
+
+SPOOL_SIZE = 16 * 1024 * 1024
+"""Bytes of a table kept in memory before it spills to a temporary file"""
+
+
+class _CountingFile(io.RawIOBase):
+    """Binary file wrapper that counts the bytes written through it."""
+
+    def __init__(self, f):
+        self.f = f
+        self.bytes = 0
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self.bytes += len(b)
+        return self.f.write(b)
+
+
+class ReportPackage:
+    """Compressed report at path (without extension) holding CSV tables.
+    Tables may be written from several threads at once."""
+
+    def __init__(self, path, codec='gz', level=6, incremental=False):
+        if codec not in CODECS:
+            raise ValueError('Unknown codec {}'.format(codec))
+        self.codec = codec
+        self.level = level
+        self.incremental = incremental
+        self.stats = {}  # member name -> {'rows', 'bytes', 'compressed_bytes'}
+        self._lock = threading.Lock()
+        self._archive = None
+        if incremental:
+            self.path = path
+            os.makedirs(path, exist_ok=True)
+        elif codec == 'zip':
+            self.path = path + '.zip'
+            self._archive = zipfile.ZipFile(
+                self.path, 'w', compression=zipfile.ZIP_DEFLATED,
+                compresslevel=level)
+        else:
+            self.path = path + '.tar.' + codec
+            option = 'preset' if codec == 'xz' else 'compresslevel'
+            self._archive = tarfile.open(
+                self.path, 'w:' + codec, **{option: level})
+
+    def _open_compressed(self, name):
+        """Open a compressed file for one table in incremental mode."""
+        path = os.path.join(self.path, name)
+        if self.codec == 'gz':
+            return path + '.gz', gzip.open(path + '.gz', 'wb', self.level)
+        if self.codec == 'bz2':
+            return path + '.bz2', bz2.open(path + '.bz2', 'wb', self.level)
+        if self.codec == 'xz':
+            return path + '.xz', lzma.open(path + '.xz', 'wb',
+                                           preset=self.level)
+        archive = zipfile.ZipFile(path + '.zip', 'w',
+                                  compression=zipfile.ZIP_DEFLATED,
+                                  compresslevel=self.level)
+        return path + '.zip', _ZipMember(archive, name)
+
+    def table(self, name, header=None):
+        """Context manager for writing the member name, yielding an object
+        with a csv writer's writerow() and the underlying text_file. The
+        header row, if given, is not counted in the table's rows."""
+        return _Table(self, name, header)
+
+    def add_text(self, name, text):
+        with self.table(name) as table:
+            table.text_file.write(text)
+
+    def _add_member(self, name, f, size):
+        """Copy size bytes of f, positioned at 0, into the archive and return
+        the compressed size if the format records it."""
+        with self._lock:
+            if self.codec == 'zip':
+                with self._archive.open(name, 'w', force_zip64=True) as dst:
+                    shutil.copyfileobj(f, dst)
+                return self._archive.getinfo(name).compress_size
+            info = tarfile.TarInfo(name)
+            info.size = size
+            info.mtime = time.time()
+            self._archive.addfile(info, f)
+            return None
+
+    def close(self):
+        if self._archive is not None:
+            self._archive.close()
+            self._archive = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    @property
+    def size(self):
+        """Total compressed bytes written."""
+        if not self.incremental:
+            return os.path.getsize(self.path)
+        return sum(s['compressed_bytes'] for s in self.stats.values())
+
+
+class _ZipMember(io.RawIOBase):
+    """Single-member zip archive written like a file."""
+
+    def __init__(self, archive, name):
+        self.archive = archive
+        self.member = archive.open(name, 'w', force_zip64=True)
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        return self.member.write(b)
+
+    def close(self):
+        if not self.closed:
+            self.member.close()
+            self.archive.close()
+        super().close()
+
+
+class _Table:
+    """One member of a ReportPackage being written, used as a csv writer."""
+
+    def __init__(self, package, name, header=None):
+        self.package = package
+        self.name = name
+        self.header = header
+        self.rows = 0
+
+    def __enter__(self):
+        self._path = None
+        if self.package.incremental:
+            self._path, self._file = self.package._open_compressed(self.name)
+        else:
+            self._file = tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE)
+        self._counter = _CountingFile(self._file)
+        self.text_file = io.TextIOWrapper(
+            self._counter, encoding='utf-8', newline='')
+        self._writer = csv.writer(self.text_file)
+        if self.header:
+            self._writer.writerow(self.header)
+        return self
+
+    def writerow(self, row):
+        self._writer.writerow(row)
+        self.rows += 1
+
+    def __exit__(self, exc_type, exc, tb):
+        self.text_file.flush()
+        self.text_file.detach()
+        try:
+            if exc_type is not None:
+                return
+            if self.package.incremental:
+                self._file.close()
+                compressed = os.path.getsize(self._path)
+            else:
+                self._file.seek(0)
+                compressed = self.package._add_member(
+                    self.name, self._file, self._counter.bytes)
+        finally:
+            self._file.close()
+            if exc_type is not None and self._path:
+                os.remove(self._path)  # leave only complete tables
+        self.package.stats[self.name] = {
+            'rows': self.rows,
+            'bytes': self._counter.bytes,
+            'compressed_bytes': compressed,
+        }
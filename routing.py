@@ -1,6 +1,16 @@
+import attr
+from itertools import islice
+import os
+import time
+from types import MappingProxyType
+from cache import TTLCache
+import common
+import jobboss.models as jb
 from jobboss.query.job import get_work_center, get_operation, get_vendor, \
     get_default_vendor, get_default_work_center
 
+logger = common.get_logger('routing')
+
 OP_MAP = {}
 """
 Example: "Saw": [["SAW", "SC"]]
@@ -11,6 +21,87 @@ To not import an operation:
 FINISH_MAP = {}
 """Example: "Anodize MIL-A-8624": [["PLATECO", "An A-8624"]]"""
 
+LOOKUP_CACHE = TTLCache()
+"""Work center, vendor and operation lookups shared by all routing lines."""
+
+CLEAR_CACHE_PATH = 'clear_cache'
+"""Created by connector.py --clear_cache; a connector running as a daemon
+clears its lookup cache when it finds this file, and removes it"""
+
+
+def cached_work_center(name):
+    return LOOKUP_CACHE.get_or_load(('work_center', name),
+                                    lambda: get_work_center(name))
+
+
+def cached_vendor(name):
+    return LOOKUP_CACHE.get_or_load(('vendor', name),
+                                    lambda: get_vendor(name))
+
+
+def cached_operation(name):
+    return LOOKUP_CACHE.get_or_load(('operation', name),
+                                    lambda: get_operation(name))
+
+
+def cached_default_work_center():
+    return LOOKUP_CACHE.get_or_load(('default_work_center',),
+                                    get_default_work_center)
+
+
+def cached_default_vendor():
+    return LOOKUP_CACHE.get_or_load(('default_vendor',), get_default_vendor)
+
+
+def warm_lookup_cache():
+    """Size the lookup cache from the config file and fill it with one query
+    each for work centers, vendors and operations."""
+    LOOKUP_CACHE.maxsize = common.JOBBOSS_CONFIG.lookup_cache_size
+    LOOKUP_CACHE.ttl = common.JOBBOSS_CONFIG.lookup_cache_ttl
+    LOOKUP_CACHE.invalidate()
+    tables = (
+        ('work_center', jb.WorkCenter, 'work_center'),
+        ('vendor', jb.Vendor, 'vendor'),
+        ('operation', jb.Operation, 'operation'),
+    )
+    per_table = LOOKUP_CACHE.maxsize // len(tables)
+    for kind, model, field in tables:
+        qs = model.objects.order_by('pk').iterator()
+        n = 0
+        for instance in islice(qs, per_table):
+            key = (kind, getattr(instance, field))
+            if LOOKUP_CACHE.get(key) is None:  # keep the first match by pk
+                LOOKUP_CACHE.put(key, instance)
+                n += 1
+        logger.info('Cached %d %s records', n, model.__name__)
+    LOOKUP_CACHE.hits = LOOKUP_CACHE.misses = 0
+
+
+def invalidate_lookup_cache():
+    """Forget all cached lookups, e.g. after work centers, vendors or
+    operations are changed in JobBOSS."""
+    global ROUTING_PLAN
+    logger.info('Clearing lookup cache %s', LOOKUP_CACHE.stats())
+    LOOKUP_CACHE.invalidate()
+    ROUTING_PLAN = None
+
+
+def request_cache_clear():
+    """Ask a running connector to clear its lookup cache at its next
+    poll."""
+    open(CLEAR_CACHE_PATH, 'w').close()
+
+
+def clear_cache_if_requested():
+    """Clear the lookup cache if request_cache_clear() was called since the
+    last check. Returns True if it was cleared."""
+    try:
+        os.remove(CLEAR_CACHE_PATH)
+    except FileNotFoundError:
+        return False
+    invalidate_lookup_cache()
+    return True
+
 
 class RoutingLine:
     _INITIAL = object()
@@ -41,12 +132,12 @@ class RoutingLine:
     @property
     def work_center_instance(self):
         if self._work_center is self._INITIAL:
-            self._work_center = get_work_center(self.wc)
+            self._work_center = cached_work_center(self.wc)
             self._has_work_center = self._work_center is not None
         if self._has_work_center:
             return self._work_center
         else:
-            return get_default_work_center()
+            return cached_default_work_center()
 
     @property
     def has_operation(self):
@@ -58,7 +149,7 @@ class RoutingLine:
     @property
     def operation_instance(self):
         if self._operation is self._INITIAL:
-            self._operation = get_operation(self.operation)
+            self._operation = cached_operation(self.operation)
             self._has_operation = self._operation is not None
         return self._operation
 
@@ -78,20 +169,20 @@ class RoutingLine:
     @property
     def vendor_instance(self):
         if self._vendor is self._INITIAL:
-            self._vendor = get_vendor(self.vendor)
+            self._vendor = cached_vendor(self.vendor)
             self._has_vendor = self._vendor is not None
         if self._has_vendor:
             return self._vendor
         else:
-            return get_default_vendor()
+            return cached_default_vendor()
 
 
 def is_outside_op(name):
-    return name in FINISH_MAP.keys()
+    return name in FINISH_MAP
 
 
 def is_inside_op(name):
-    return name in OP_MAP.keys()
+    return name in OP_MAP
 
 
 BAD_MAP_NOTE_TEXT = 'Paperless Parts could not match this operation to a ' \
@@ -114,3 +205,123 @@ def generate_routing_lines(pp_name):
                               description=pp_name)
     else:
         yield RoutingLine(wc=pp_name, is_inside=True, description=pp_name)
+
+
+@attr.s(frozen=True, slots=True)
+class ResolvedRoutingLine:
+    """A routing line with its JobBOSS lookups done, holding exactly the
+    values copied onto a JobOperation."""
+    description = attr.ib()
+    is_inside = attr.ib()
+    wc_vendor = attr.ib()
+    work_center = attr.ib(default=None)
+    vendor = attr.ib(default=None)
+    operation_service = attr.ib(default=None)
+    has_operation = attr.ib(default=False)
+    operation_note_text = attr.ib(default=None)
+    workcenter_oid = attr.ib(default=None)
+    queue_hrs = attr.ib(default=0)
+
+    @classmethod
+    def resolve(cls, line: RoutingLine):
+        if not line.is_inside:
+            vendor = line.vendor_instance
+            return cls(
+                description=line.description,
+                is_inside=False,
+                wc_vendor=vendor.vendor,
+                vendor=vendor,
+                operation_service=line.service[0:10] if line.service
+                else line.service,
+            )
+        wc = line.work_center_instance
+        return cls(
+            description=line.description,
+            is_inside=True,
+            wc_vendor=wc.work_center,
+            work_center=wc,
+            operation_service=line.operation[0:10] if line.has_operation
+            else None,
+            has_operation=line.has_operation,
+            operation_note_text=line.operation_instance.note_text
+            if line.has_operation else None,
+            workcenter_oid=wc.objectid,
+            queue_hrs=wc.queue_hrs,
+        )
+
+
+def describe_unmapped(line: RoutingLine):
+    """Return a message if line does not resolve to the JobBOSS records it
+    names, otherwise None."""
+    if not line.is_inside and not line.has_vendor:
+        return 'vendor {}'.format(line.vendor)
+    if line.is_inside and not line.has_work_center:
+        return 'work center {}'.format(line.wc)
+    if line.is_inside and line.operation and not line.has_operation:
+        return 'operation {}'.format(line.operation)
+    return None
+
+
+class RoutingPlan:
+    """Every Paperless operation name in OP_MAP and FINISH_MAP compiled to a
+    tuple of resolved routing lines. Names that are not mapped are resolved
+    on first use and remembered in a cache sized and expiring like the
+    lookup cache. The plan itself expires after ttl seconds, so that
+    changes to work centers, vendors and operations are picked up."""
+
+    def __init__(self, maxsize=4096, ttl=3600):
+        self.expires = time.monotonic() + ttl
+        compiled = {}
+        self.unmapped = []
+        for pp_name in list(FINISH_MAP) + list(OP_MAP):
+            if pp_name in compiled:
+                continue
+            lines = list(generate_routing_lines(pp_name))
+            for line in lines:
+                problem = describe_unmapped(line)
+                if problem:
+                    self.unmapped.append((pp_name, problem))
+            compiled[pp_name] = tuple(
+                ResolvedRoutingLine.resolve(line) for line in lines)
+        self._compiled = MappingProxyType(compiled)
+        self._unmapped_names = TTLCache(maxsize, ttl)
+
+    def __len__(self):
+        return len(self._compiled)
+
+    def lines(self, pp_name):
+        try:
+            return self._compiled[pp_name]
+        except KeyError:
+            pass
+        return self._unmapped_names.get_or_load(pp_name, lambda: tuple(
+            ResolvedRoutingLine.resolve(line)
+            for line in generate_routing_lines(pp_name)))
+
+    @property
+    def expired(self):
+        return time.monotonic() > self.expires
+
+
+ROUTING_PLAN = None
+
+
+def compile_routing_plan():
+    """Build the routing plan and log any mapped work centers, operations or
+    vendors that do not exist in JobBOSS."""
+    global ROUTING_PLAN
+    plan = RoutingPlan(LOOKUP_CACHE.maxsize, LOOKUP_CACHE.ttl)
+    for pp_name, problem in plan.unmapped:
+        logger.warning('Routing for "%s" refers to unknown %s', pp_name,
+                       problem)
+    logger.info('Compiled routing for %d operations', len(plan))
+    ROUTING_PLAN = plan
+    return plan
+
+
+def get_routing_plan():
+    """Return the routing plan, compiling it again once it has expired."""
+    plan = ROUTING_PLAN
+    if plan is None or plan.expired:
+        return compile_routing_plan()
+    return plan
@@ -0,0 +1,339 @@
+"""
+Snapshots of the JobBOSS database for checking what an import changed, in a
+format that can be written and compared without holding a whole table in
+memory.
+
+A snapshot is a folder with a manifest.json and, for each table, a number of
+gzipped JSON-lines bucket files. Each line is [primary key, row hash, row
+values]; a row goes in the bucket chosen by a hash of its primary key, so two
+snapshots are compared one bucket at a time. Bucket counts are powers of two,
+so snapshots of a table taken at different sizes can still be matched up.
+
+An incremental snapshot holds only the rows whose last_updated is newer than
+in its base snapshot, and is read as the base overlaid with those rows.
+Deleted rows are not detected in tables captured incrementally.
+
+A scoped snapshot covers only the tables process_order writes, and only the
+rows numbered above the AutoNumber watermark or updated since the time
+recorded when the first snapshot of a pair was taken, so checking what one
+import changed takes seconds.
+
+Comparing snapshots only reads files, so Django and the JobBOSS models are
+imported only by the functions that read the database.
+"""
+from concurrent.futures import ThreadPoolExecutor
+import datetime
+import gzip
+import hashlib
+import json
+import os
+import zlib
+import common
+
+logger = common.get_logger('snapshot')
+
+BUCKET_ROWS = 50000
+"""Target number of rows per bucket file; bounds the memory used to compare"""
+
+CHUNK_SIZE = 2000
+"""Rows fetched from the database at a time"""
+
+WORKERS = 4
+"""Tables snapshotted or compared at the same time"""
+
+
+def jobboss_models():
+    from django.apps import apps
+    import jobboss.models as jb
+    app_label = jb.Job._meta.app_label
+    return [m for m in apps.get_models() if m._meta.app_label == app_label]
+
+
+def _dumps(value):
+    return json.dumps(value, default=str)
+
+
+def bucket_of(pk, buckets):
+    return zlib.crc32(_dumps(pk).encode()) % buckets
+
+
+def bucket_count(rows):
+    n = 1
+    while n * BUCKET_ROWS < rows:
+        n *= 2
+    return n
+
+
+def row_hash(row):
+    return hashlib.blake2b(_dumps(row).encode(), digest_size=8).hexdigest()
+
+
+class Snapshot:
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'manifest.json')) as f:
+            self.manifest = json.load(f)
+        base = self.manifest.get('base')
+        self.base = Snapshot(base) if base else None
+
+    @property
+    def tables(self):
+        return self.manifest['tables']
+
+    def _bucket_path(self, table, j):
+        return os.path.join(self.path, table, '{}.jsonl.gz'.format(j))
+
+    def read_bucket(self, table, j):
+        """Return {primary key: (row hash, row)} for bucket j of table,
+        including the rows inherited from the base snapshot."""
+        info = self.tables[table]
+        rows = self.base.read_bucket(table, j) \
+            if info.get('incremental') else {}
+        with gzip.open(self._bucket_path(table, j), 'rt') as f:
+            for line in f:
+                pk, h, row = json.loads(line)
+                rows[_key(pk)] = (h, row)
+        return rows
+
+    def rows_in_bucket(self, table, j, buckets):
+        """Rows that fall in bucket j of buckets, a multiple of this
+        snapshot's bucket count for table."""
+        own = self.tables[table]['buckets']
+        rows = self.read_bucket(table, j % own)
+        if buckets == own:
+            return rows
+        return {pk: v for pk, v in rows.items()
+                if bucket_of(_unkey(pk), buckets) == j}
+
+
+def _key(pk):
+    """Primary keys as dict keys; composite keys come back from JSON as
+    lists."""
+    return tuple(pk) if isinstance(pk, list) else pk
+
+
+def _unkey(key):
+    return list(key) if isinstance(key, tuple) else key
+
+
+def snapshot_table(path, model, base=None, filter_q=None):
+    """Write the rows of model (matching filter_q, if given) to bucket files
+    under path and return the table's manifest entry. If base, a Snapshot
+    containing the table, is given and the table has a last_updated column,
+    only rows updated since base are written."""
+    table = model._meta.db_table
+    fields = [f.attname for f in model._meta.concrete_fields]
+    pk = model._meta.pk.attname
+    pk_index = fields.index(pk)
+    lu_index = fields.index('last_updated') \
+        if 'last_updated' in fields else None
+    qs = model.objects.all()
+    if filter_q is not None:
+        qs = qs.filter(filter_q)
+    incremental = False
+    base_info = base.tables.get(table) if base else None
+    if base_info and lu_index is not None:
+        incremental = True
+        buckets = base_info['buckets']
+        since = base_info.get('last_updated')
+        if since:
+            qs = qs.filter(last_updated__gt=datetime.datetime.fromisoformat(
+                since))
+    else:
+        buckets = bucket_count(qs.count())
+
+    os.makedirs(os.path.join(path, table), exist_ok=True)
+    files = [gzip.open(os.path.join(path, table, '{}.jsonl.gz'.format(j)),
+                       'wt', compresslevel=6) for j in range(buckets)]
+    n = 0
+    last_updated = base_info.get('last_updated') if incremental else None
+    try:
+        for row in qs.values_list(*fields).iterator(chunk_size=CHUNK_SIZE):
+            row = json.loads(_dumps(row))  # as it will be read back
+            key = row[pk_index]
+            files[bucket_of(key, buckets)].write(
+                _dumps([key, row_hash(row), row]) + '\n')
+            n += 1
+            if lu_index is not None and row[lu_index] and \
+                    (last_updated is None or row[lu_index] > last_updated):
+                last_updated = row[lu_index]
+    finally:
+        for f in files:
+            f.close()
+    return table, {
+        'model': model.__name__,
+        'pk': pk,
+        'fields': fields,
+        'buckets': buckets,
+        'rows': n,
+        'last_updated': last_updated,
+        'incremental': incremental,
+    }
+
+
+def scoped_models():
+    """Tables written by process_order"""
+    import jobboss.models as jb
+    return (
+        jb.AutoNumber,
+        jb.SoHeader,
+        jb.SoDetail,
+        jb.Delivery,
+        jb.Attachment,
+        jb.Job,
+        jb.BillOfJobs,
+        jb.MaterialReq,
+        jb.JobOperation,
+        jb.Material,
+        jb.Customer,
+        jb.Contact,
+        jb.Address,
+    )
+
+
+def take_watermark():
+    """Return the current AutoNumber values and time, above which a scoped
+    snapshot captures rows."""
+    from autonumber import AUTONUMBER_FIELDS
+    import jobboss.models as jb
+    types = [an_type for an_type, _, _ in AUTONUMBER_FIELDS.values()]
+    last = dict(jb.AutoNumber.objects.filter(type__in=types).values_list(
+        'type', 'last_nbr'))
+    now = datetime.datetime.now()
+    # materials are stamped in UTC, everything else in local time
+    since = min(now, datetime.datetime.utcnow())
+    return {
+        'autonumbers': {t: last.get(t, 0) for t in types},
+        'since': since.isoformat(),
+    }
+
+
+def scoped_filters(watermark):
+    """Map each of scoped_models() to a Q object selecting the rows written
+    since watermark: those numbered above the AutoNumber values, and those
+    updated since its time. Customers, contacts and addresses are few and
+    may be updated anywhere, so they are captured whole."""
+    from django.db.models import Q
+    from autonumber import AUTONUMBER_FIELDS
+    import jobboss.models as jb
+    since = datetime.datetime.fromisoformat(watermark['since'])
+    recent = Q(last_updated__gte=since)
+    filters = {
+        jb.AutoNumber: Q(type__in=list(watermark['autonumbers'])),
+        jb.SoDetail: Q(sales_order__gt=watermark['autonumbers'][
+            'SalesOrder']) | recent,
+    }
+    for model, (an_type, field, key_type) in AUTONUMBER_FIELDS.items():
+        if key_type is int:
+            filters[model] = Q(**{field + '__gt': watermark['autonumbers'][
+                an_type]}) | recent
+    for model in (jb.Job, jb.BillOfJobs, jb.MaterialReq, jb.JobOperation,
+                  jb.Material):
+        filters[model] = recent
+    return filters
+
+
+def create_scoped_snapshot(path, watermark_path=None):
+    """Scoped snapshot into the folder path. The first snapshot of a pair
+    records a new watermark; pass its path as watermark_path when taking the
+    second so that both cover the same rows."""
+    if watermark_path:
+        watermark = Snapshot(watermark_path).manifest['watermark']
+    else:
+        watermark = take_watermark()
+    return create_snapshot(path, models=scoped_models(),
+                           filters=scoped_filters(watermark),
+                           watermark=watermark)
+
+
+def create_snapshot(path, base_path=None, models=None, filters=None,
+                    watermark=None):
+    """Snapshot the given models (default: all JobBOSS tables) into the folder
+    path, WORKERS tables at a time. With base_path, tables with a
+    last_updated column are captured incrementally. filters optionally maps
+    a model to a Q object restricting the rows captured."""
+    base = Snapshot(base_path) if base_path else None
+    models = models or jobboss_models()
+    filters = filters or {}
+    os.makedirs(path, exist_ok=True)
+    with ThreadPoolExecutor(max_workers=WORKERS) as executor:
+        futures = [executor.submit(common.on_own_connection, snapshot_table,
+                                   path, model, base, filters.get(model))
+                   for model in models]
+        tables = dict(future.result() for future in futures)
+    manifest = {
+        'created': datetime.datetime.now().isoformat(timespec='seconds'),
+        'base': os.path.abspath(base_path) if base_path else None,
+        'watermark': watermark,
+        'tables': tables,
+    }
+    with open(os.path.join(path, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=2)
+    logger.info('Snapshot %s: %d tables, %d rows', path, len(tables),
+                sum(t['rows'] for t in tables.values()))
+    return manifest
+
+
+def compare_table(old: Snapshot, new: Snapshot, table, out=None):
+    """Compare table between two snapshots one bucket at a time. Writes one
+    JSON line per added, deleted or changed row to the text file out, if
+    given, and returns the counts of each."""
+    counts = {'added': 0, 'deleted': 0, 'changed': 0}
+    fields = new.tables[table]['fields']
+    buckets = max(old.tables[table]['buckets'],
+                  new.tables[table]['buckets'])
+    changes = []
+    for j in range(buckets):
+        old_rows = old.rows_in_bucket(table, j, buckets)
+        new_rows = new.rows_in_bucket(table, j, buckets)
+        for pk, (h, row) in new_rows.items():
+            old_row = old_rows.pop(pk, None)
+            if old_row is None:
+                counts['added'] += 1
+                changes.append({'table': table, 'pk': pk, 'change': 'added',
+                                'row': dict(zip(fields, row))})
+            elif old_row[0] != h:
+                counts['changed'] += 1
+                changes.append({'table': table, 'pk': pk, 'change': 'changed',
+                                'fields': {
+                                    field: [a, b] for field, a, b in
+                                    zip(fields, old_row[1], row) if a != b}})
+        for pk, (h, row) in old_rows.items():
+            counts['deleted'] += 1
+            changes.append({'table': table, 'pk': pk, 'change': 'deleted',
+                            'row': dict(zip(fields, row))})
+        if out is not None and changes:
+            out.write(''.join(_dumps(c) + '\n' for c in changes))
+        changes = []
+    return table, counts
+
+
+def compare_snapshots(old_path, new_path, report_path=None):
+    """Compare the tables common to two snapshots, WORKERS tables at a time.
+    Logs a summary, writes the changed rows as JSON lines to report_path (one
+    file per table, report_path.<table>.jsonl) if given, and returns
+    {table: counts} for tables with changes."""
+    old, new = Snapshot(old_path), Snapshot(new_path)
+    tables = [t for t in new.tables if t in old.tables]
+    for t in set(old.tables).symmetric_difference(new.tables):
+        logger.warning('Table %s is only in one snapshot; not compared', t)
+
+    def compare(table):
+        if report_path is None:
+            return compare_table(old, new, table)
+        path = '{}.{}.jsonl'.format(report_path, table)
+        with open(path, 'w') as out:
+            result = compare_table(old, new, table, out)
+        if not any(result[1].values()):
+            os.remove(path)
+        return result
+
+    with ThreadPoolExecutor(max_workers=WORKERS) as executor:
+        results = dict(executor.map(compare, tables))
+    changed = {t: c for t, c in results.items() if any(c.values())}
+    for table, c in sorted(changed.items()):
+        logger.info('%s: %d added, %d changed, %d deleted', table,
+                    c['added'], c['changed'], c['deleted'])
+    if not changed:
+        logger.info('No differences in %d tables', len(tables))
+    return changed
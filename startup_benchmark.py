@@ -0,0 +1,119 @@
+"""
+Measures how long the connector's command line modes take to start, by
+running connector.py in each mode with --startup_only, which exits once the
+mode has loaded its modules, in a fresh interpreter with python -X
+importtime. For each mode it reports the total import time and the top-level
+modules that took longest, keeping the fastest of --repeat runs.
+
+To run the benchmark:
+
+1. activate virtual environment; for example:
+    source osenv/bin/activate
+
+2. run this module as a script:
+    python startup_benchmark.py
+
+Pass --save-baseline to record the results, and later runs will be compared
+against them. The run exits with status 1 if a mode got slower than
+--tolerance allows or loads more top-level modules.
+"""
+import argparse
+import subprocess
+import sys
+import baselines
+
+BASELINE_PATH = 'startup_baseline.json'
+
+
+def _connector(*args):
+    return ['connector.py', '--startup_only'] + list(args)
+
+
+SCENARIOS = {
+    'help': ['connector.py', '--help'],
+    'test': _connector('--test'),
+    'compare_snapshots': _connector(
+        '--compare_db_snapshots', '--old_snapshot_file_path', 'old',
+        '--snapshot_file_path', 'new'),
+    'create_snapshot': _connector('--create_db_snapshot',
+                                  '--snapshot_file_path', 'new'),
+    'clear_cache': _connector('--clear_cache'),
+    'order': _connector('--order_num', '1'),
+    'daemon': _connector('--daemon'),
+    'analyzer_help': ['analyzer.py', '--help'],
+}
+"""Mode -> interpreter arguments running that mode"""
+
+
+def parse_importtime(stderr):
+    """Return {module: cumulative microseconds} for the modules imported at
+    the top level, from the output of python -X importtime."""
+    modules = {}
+    for line in stderr.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        parts = line[len('import time:'):].split('|')
+        if len(parts) != 3 or not parts[1].strip().isdigit():
+            continue  # the header line
+        name = parts[2]
+        if name.startswith('  '):
+            continue  # imported by another module, counted in its time
+        modules[name.strip()] = int(parts[1])
+    return modules
+
+
+def measure(args):
+    """Run args in a fresh interpreter and return its top-level imports."""
+    proc = subprocess.run([sys.executable, '-X', 'importtime'] + args,
+                          stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                          universal_newlines=True)
+    if proc.returncode != 0:
+        raise RuntimeError('{} failed:\n{}'.format(' '.join(args), '\n'.join(
+            line for line in proc.stderr.splitlines()
+            if not line.startswith('import time:'))))
+    return parse_importtime(proc.stderr)
+
+
+def run(scenario, repeat, top):
+    """Return the total import seconds and top modules of the fastest of
+    repeat runs of scenario."""
+    fastest = None
+    for _ in range(repeat):
+        modules = measure(SCENARIOS[scenario])
+        if fastest is None or sum(modules.values()) < sum(fastest.values()):
+            fastest = modules
+    slowest = sorted(fastest.items(), key=lambda m: -m[1])[:top]
+    return {
+        'seconds': sum(fastest.values()) / 1e6,
+        'modules': len(fastest),
+        'top': {name: us / 1e6 for name, us in slowest},
+    }
+
+
+def print_results(results):
+    print('{:<20} {:>10} {:>8}  {}'.format('mode', 'seconds', 'modules',
+                                           'slowest imports'))
+    for scenario, r in results.items():
+        print('{:<20} {:>10.4f} {:>8}  {}'.format(
+            scenario, r['seconds'], r['modules'], ', '.join(
+                '{} {:.3f}'.format(name, s) for name, s in r['top'].items())))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('modes', nargs='*',
+                        help='Modes to measure, of {}; default all.'.format(
+                            ', '.join(SCENARIOS)))
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--top', type=int, default=3,
+                        help='Number of slowest imports to list per mode.')
+    baselines.add_arguments(parser, BASELINE_PATH, 'mode')
+    args = parser.parse_args()
+    for mode in args.modes:
+        if mode not in SCENARIOS:
+            parser.error('Unknown mode {}'.format(mode))
+
+    results = {scenario: run(scenario, args.repeat, args.top)
+               for scenario in args.modes or SCENARIOS}
+    print_results(results)
+    baselines.check(args, 'startup', results, counts=('modules',))
@@ -0,0 +1,269 @@
+"""
+Row templates for the JobBOSS rows created in bulk while importing an order.
+A RowTemplate holds the value of every column of a model up front, so that
+building a row only sets the columns that differ and creates the instance
+from positional values, which Django does much faster than from keyword
+arguments. The constant columns of each row type are listed here, in one
+place, to be adjusted per shop.
+"""
+import jobboss.models as jb
+
+JOB_DEFAULTS = dict(
+    status='Active',
+    build_to_stock=True,
+    pick_quantity=0,
+    split_quantity=0,
+    completed_quantity=0,
+    shipped_quantity=0,
+    fg_transfer_qty=0,
+    returned_quantity=0,
+    in_production_quantity=0,
+    assembly_level=0,
+    certs_required=False,
+    time_and_materials=False,
+    open_operations=0,
+    est_rem_hrs=0,
+    est_total_hrs=0,
+    est_labor=0,
+    est_material=0,
+    est_service=0,
+    est_labor_burden=0,
+    est_machine_burden=0,
+    est_ga_burden=0,
+    act_revenue=0,
+    act_scrap_quantity=0,
+    act_total_hrs=0,
+    act_labor=0,
+    act_material=0,
+    act_service=0,
+    act_labor_burden=0,
+    act_machine_burden=0,
+    act_ga_burden=0,
+    priority=5,
+    price_uofm='ea',
+    currency_conv_rate=1,
+    trade_currency=1,
+    fixed_rate=True,
+    customer_po_ln=None,
+    quantity_per=1,
+    profit_pct=0,
+    labor_markup_pct=0,
+    mat_markup_pct=0,
+    serv_markup_pct=0,
+    labor_burden_markup_pct=0,
+    machine_burden_markup_pct=0,
+    ga_burden_markup_pct=0,
+    profit_markup='M',
+    prepaid_amt=0,
+    split_to_job=False,
+    order_unit='ea',
+    price_unit_conv=1,
+    source='System',
+    plan_modified=False,
+    prepaid_tax_amount=0,
+    prepaid_trade_amt=0,
+    commissionincluded=False,
+)
+
+JOB_OPERATION_DEFAULTS = dict(
+    priority=5,
+    run_method='Min/Part',
+    efficiency_pct=100,
+    attended_pct=100,
+    queue_hrs=0,
+    est_setup_labor=0,
+    est_run_labor=0,
+    est_labor_burden=0,
+    est_machine_burden=0,
+    est_ga_burden=0,
+    est_unit_cost=0,
+    est_addl_cost=0,
+    est_total_cost=0,
+    act_setup_hrs=0,
+    act_run_hrs=0,
+    act_run_qty=0,
+    act_scrap_qty=0,
+    act_setup_labor=0,
+    act_run_labor=0,
+    act_labor_burden=0,
+    act_machine_burden=0,
+    act_ga_burden=0,
+    act_unit_cost=0,
+    act_addl_cost=0,
+    act_total_cost=0,
+    setup_pct_complete=0,
+    run_pct_complete=0,
+    overlap=0,
+    overlap_qty=0,
+    est_ovl_hrs=0,
+    lead_days=0,
+    schedule_exception_old=False,
+    status='O',
+    minimum_chg_amt=0,
+    cost_unit_conv=0,
+    currency_conv_rate=1,
+    fixed_rate=True,
+    rwk_quantity=0,
+    rwk_setup_hrs=0,
+    rwk_run_hrs=0,
+    rwk_setup_labor=0,
+    rwk_run_labor=0,
+    rwk_labor_burden=0,
+    rwk_machine_burden=0,
+    rwk_ga_burden=0,
+    rwk_scrap_qty=0,
+    act_run_labor_hrs=0,
+    setup_qty=0,
+    run_qty=0,
+    rwk_run_labor_hrs=0,
+    rwk_setup_qty=0,
+    rwk_run_qty=0,
+    act_setup_labor_hrs=0,
+    rwk_setup_labor_hrs=0,
+    sched_resources=1,
+    lag_hours=0,
+    manual_start_lock=False,
+    manual_stop_lock=False,
+    priority_zero_lock=False,
+    firm_zone_lock=False,
+    sb_runmethod=None,
+)
+
+MATERIAL_REQ_DEFAULTS = dict(
+    pick_buy_indicator='B',
+    type='M',
+    status='O',
+    quantity_per_basis='I',
+    quantity_per=0,
+    uofm='ea',
+    deferred_qty=0,
+    est_qty=0,
+    est_unit_cost=0,
+    est_addl_cost=0,
+    est_total_cost=0,
+    act_qty=0,
+    act_unit_cost=0,
+    act_addl_cost=0,
+    act_total_cost=0,
+    part_length=0,
+    part_width=0,
+    bar_end=0,
+    cutoff=0,
+    facing=0,
+    bar_length=0,
+    lead_days=0,
+    currency_conv_rate=1,
+    trade_currency=1,
+    fixed_rate=True,
+    certs_required=False,
+    manual_link=False,
+    cost_uofm='ea',
+    cost_unit_conv=1,
+    quantity_multiplier=1,
+    partial_res=False,
+    affects_schedule=False,
+    rounded=True,
+)
+"""Raw material requirement added to every manufactured component's job"""
+
+HARDWARE_REQ_DEFAULTS = dict(
+    pick_buy_indicator='B',
+    type='H',
+    status='O',
+    quantity_per_basis='I',
+    uofm='ea',
+    deferred_qty=0,
+    est_unit_cost=0,
+    est_addl_cost=0,
+    est_total_cost=0,
+    act_qty=0,
+    act_unit_cost=0,
+    act_total_cost=0,
+    part_length=0,
+    part_width=0,
+    bar_end=0,
+    facing=0,
+    bar_length=0,
+    lead_days=0,
+    currency_conv_rate=1,
+    trade_currency=1,
+    fixed_rate=1,
+    certs_required=0,
+    manual_link=1,
+    cost_uofm='ea',
+    cost_unit_conv=1,
+    quantity_multiplier=1,
+    partial_res=0,
+    affects_schedule=0,
+    rounded=1,
+)
+"""Material requirement for a purchased component"""
+
+
+class RowTemplate:
+    """Builds instances of model with the given column defaults. Columns
+    may be named by field name or attribute name; related instances are
+    stored by key and also cached on the row, as assignment would."""
+
+    def __init__(self, model, **defaults):
+        self.model = model
+        self._fields = model._meta.concrete_fields
+        self._index = {}  # field name or attname -> position
+        for i, field in enumerate(self._fields):
+            self._index[field.name] = i
+            self._index[field.attname] = i
+        self._values = [None] * len(self._fields)
+        self._related = {}  # position -> related instance
+        self._dynamic = []  # positions with a callable model default
+        for i, field in enumerate(self._fields):
+            if field.has_default() and callable(field.default):
+                self._dynamic.append(i)
+            else:
+                self._values[i] = field.get_default()
+        self._set_defaults(defaults)
+
+    def _set_defaults(self, fields):
+        self._set(self._values, self._related, fields)
+        overridden = {self._index[name] for name in fields}
+        self._dynamic = [i for i in self._dynamic if i not in overridden]
+
+    def _set(self, values, related, fields):
+        for name, value in fields.items():
+            i = self._index[name]
+            field = self._fields[i]
+            if field.is_relation and hasattr(value, '_meta'):
+                related[i] = value
+                value = getattr(value, field.target_field.attname)
+            else:
+                related.pop(i, None)
+            values[i] = value
+
+    def derive(self, **fields):
+        """Return a template with these defaults added, e.g. the columns
+        shared by all rows of one order."""
+        template = object.__new__(RowTemplate)
+        template.__dict__.update(self.__dict__)
+        template._values = list(self._values)
+        template._related = dict(self._related)
+        template._dynamic = list(self._dynamic)
+        template._set_defaults(fields)
+        return template
+
+    def build(self, **fields):
+        """Return a new unsaved instance with fields set."""
+        values = list(self._values)
+        related = dict(self._related)
+        for i in self._dynamic:
+            values[i] = self._fields[i].get_default()
+        if fields:
+            self._set(values, related, fields)
+        instance = self.model(*values)
+        for i, value in related.items():
+            self._fields[i].set_cached_value(instance, value)
+        return instance
+
+
+JOB = RowTemplate(jb.Job, **JOB_DEFAULTS)
+JOB_OPERATION = RowTemplate(jb.JobOperation, **JOB_OPERATION_DEFAULTS)
+MATERIAL_REQ = RowTemplate(jb.MaterialReq, **MATERIAL_REQ_DEFAULTS)
+HARDWARE_REQ = RowTemplate(jb.MaterialReq, **HARDWARE_REQ_DEFAULTS)
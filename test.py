@@ -40,6 +40,8 @@ class ConnectorTest(unittest.TestCase):
             system_generated=True,
             last_nbr=1
         )
+        import ledger
+        ledger.LEDGER = ledger.Ledger()  # in memory
         from job import process_order
         with open('core-python/tests/unit/mock_data/order.json') as data_file:
             mock_order_json = json.load(data_file)
@@ -62,6 +64,294 @@ class ConnectorTest(unittest.TestCase):
                 op_count += len(comp.shop_operations)
         addon_count = sum(len(oi.ordered_add_ons) for oi in order.order_items)
         self.assertEqual(op_count, jb.JobOperation.objects.count())
+        entry = ledger.LEDGER.get(order.number)
+        self.assertEqual(1, jb.SoHeader.objects.count())
+        self.assertEqual(entry.sales_order,
+                         jb.SoHeader.objects.get().sales_order)
+        self.assertEqual(entry, process_order(order))  # not imported again
+        self.assertEqual(1, jb.SoHeader.objects.count())
+
+    def test_import_modes(self):
+        import copy
+        import jobboss.models as jb
+        import ledger
+        from job import process_order
+        for an_type in ('SalesOrder', 'Job'):
+            jb.AutoNumber.objects.get_or_create(
+                type=an_type, defaults={'system_generated': True,
+                                        'last_nbr': 1})
+        ledger.LEDGER = ledger.Ledger()  # in memory
+        with open('core-python/tests/unit/mock_data/order.json') as data_file:
+            mock_order_json = json.load(data_file)
+        copies = copy.deepcopy(mock_order_json['order_items'])
+        for order_item in copies:
+            order_item['id'] += 1000
+        mock_order_json['order_items'] += copies
+        client = PaperlessClient()
+        client.get_resource = MagicMock(return_value=mock_order_json)
+        order = Order.get(2)
+
+        def summary(**config):
+            saved = {k: getattr(common.JOBBOSS_CONFIG, k) for k in config}
+            vars(common.JOBBOSS_CONFIG).update(config)
+            try:
+                entry = process_order(order, force=True)
+            finally:
+                vars(common.JOBBOSS_CONFIG).update(saved)
+            so_details = jb.SoDetail.objects.filter(
+                sales_order=entry.sales_order)
+            return [
+                sorted(so_details.values_list('so_line', 'order_qty')),
+                jb.Delivery.objects.filter(
+                    so_detail__in=so_details.values_list('so_detail')).count(),
+            ] + [
+                [sorted(j[len(top):] for j in jb.Job.objects.filter(
+                    top_lvl_job=top).values_list('job', flat=True)),
+                 jb.JobOperation.objects.filter(job__top_lvl_job=top).count(),
+                 jb.MaterialReq.objects.filter(job__top_lvl_job=top).count()]
+                for top in entry.jobs
+            ]
+
+        serial = summary()
+        self.assertEqual(2 * len(copies), len(serial[0]))
+        self.assertEqual(serial, summary(bulk_insert=True))
+
+    def test_ledger_update(self):
+        import jobboss.models as jb
+        import ledger
+        from job import process_order
+        for an_type in ('SalesOrder', 'Job'):
+            jb.AutoNumber.objects.get_or_create(
+                type=an_type, defaults={'system_generated': True,
+                                        'last_nbr': 1})
+        ledger.LEDGER = ledger.Ledger()  # in memory
+        with open('core-python/tests/unit/mock_data/order.json') as data_file:
+            mock_order_json = json.load(data_file)
+        client = PaperlessClient()
+        client.get_resource = MagicMock(return_value=mock_order_json)
+        entry = process_order(Order.get(3))
+        mock_order_json['payment_details']['purchase_order_number'] = 'PO-2'
+        mock_order_json['order_items'][0]['quantity'] += 1
+        quantity = mock_order_json['order_items'][0]['quantity']
+        order = Order.get(3)
+        self.assertIsNone(process_order(order))  # ledger_update is off
+        common.JOBBOSS_CONFIG.ledger_update = True
+        try:
+            updated = process_order(order)
+        finally:
+            common.JOBBOSS_CONFIG.ledger_update = False
+        self.assertEqual((entry.sales_order, entry.jobs),
+                         (updated.sales_order, updated.jobs))
+        self.assertEqual(updated, ledger.LEDGER.get(order.number))
+        self.assertEqual('PO-2', jb.SoHeader.objects.get(
+            sales_order=entry.sales_order).customer_po)
+        jobs = jb.Job.objects.filter(top_lvl_job__in=entry.jobs)
+        self.assertEqual({'PO-2'}, set(jobs.values_list('customer_po',
+                                                        flat=True)))
+        self.assertEqual({quantity}, set(jobs.filter(
+            top_lvl_job=entry.jobs[0]).values_list('order_quantity',
+                                                   flat=True)))
+        so_detail = jb.SoDetail.objects.get(sales_order=entry.sales_order,
+                                            so_line='001')
+        self.assertEqual(quantity, so_detail.order_qty)
+        self.assertEqual(quantity, jb.Delivery.objects.get(
+            so_detail=so_detail.so_detail).promised_quantity)
+
+    def test_plan_order(self):
+        import jobboss.models as jb
+        from job import plan_order
+        from writer import PlanWriter
+        writer = PlanWriter(bulk=True)
+        writer.add(jb.Job())
+        writer.add(jb.Attachment())
+        header = writer.insert(jb.SoHeader())
+        self.assertEqual(-1, header.pk)
+        writer.flush()
+        self.assertEqual(['SoHeader', 'Attachment', 'Job'],
+                         [r['model'] for r in writer.records()])
+
+        for an_type in ('SalesOrder', 'Job'):
+            jb.AutoNumber.objects.get_or_create(
+                type=an_type, defaults={'system_generated': True,
+                                        'last_nbr': 1})
+        with open('core-python/tests/unit/mock_data/order.json') as data_file:
+            mock_order_json = json.load(data_file)
+        client = PaperlessClient()
+        client.get_resource = MagicMock(return_value=mock_order_json)
+        order = Order.get(1)
+        headers = jb.SoHeader.objects.count()
+        models = [r['model'] for r in plan_order(order)]
+        self.assertEqual(headers, jb.SoHeader.objects.count())
+        self.assertEqual(1, models.count('SoHeader'))
+        self.assertNotIn('Material', models[models.index('SoHeader'):])
+        self.assertEqual(
+            sum(len([c for c in oi.components if not c.is_hardware])
+                for oi in order.order_items),
+            models.count('Job'))
+
+    def test_autonumber_block(self):
+        import jobboss.models as jb
+        from autonumber import AutoNumberAllocator
+        jb.AutoNumber.objects.create(
+            type='Delivery',
+            system_generated=True,
+            last_nbr=10
+        )
+        allocator = AutoNumberAllocator()
+        allocator.reserve(jb.Delivery, 3)
+        self.assertEqual(
+            13, jb.AutoNumber.objects.get(type='Delivery').last_nbr)
+        numbers = [allocator.assign(jb.Delivery()).delivery for _ in range(3)]
+        self.assertEqual([11, 12, 13], numbers)
+        self.assertEqual({}, allocator.unused)
+
+    def test_lookup_cache(self):
+        from cache import TTLCache
+        cache = TTLCache(maxsize=2, ttl=60)
+        loads = []
+        loader = lambda: loads.append(1)  # returns None, which is cached
+        self.assertIsNone(cache.get_or_load('a', loader))
+        self.assertIsNone(cache.get_or_load('a', loader))
+        self.assertEqual(1, len(loads))
+        cache.put('b', 2)
+        cache.put('c', 3)
+        self.assertEqual(2, len(cache))
+        self.assertIsNone(cache.get('a'))  # evicted as least recently used
+        self.assertEqual(3, cache.get('c'))
+        cache.ttl = -1
+        cache.put('d', 4)
+        self.assertIsNone(cache.get('d'))  # expired
+        cache.invalidate()
+        self.assertEqual(0, len(cache))
+        self.assertEqual({'size': 0, 'hits': 2, 'misses': 3}, cache.stats())
+
+    def test_routing_plan_expiry(self):
+        import routing
+        routing.ROUTING_PLAN = routing.RoutingPlan(ttl=-1)
+        self.assertTrue(routing.ROUTING_PLAN.expired)
+        plan = routing.get_routing_plan()  # compiled again
+        self.assertFalse(plan.expired)
+        self.assertIs(plan, routing.get_routing_plan())
+
+    def test_customer_cache(self):
+        import datetime
+        from unittest.mock import patch
+        import jobboss.models as jb
+        import customers
+        customers.CUSTOMER_CACHE = customers.CustomerCache()  # in memory
+        with open('core-python/tests/unit/mock_data/order.json') as data_file:
+            mock_order_json = json.load(data_file)
+        client = PaperlessClient()
+        client.get_resource = MagicMock(return_value=mock_order_json)
+        order = Order.get(1)
+        with patch('customers.get_or_create_customer',
+                   wraps=customers.get_or_create_customer) as lookup:
+            customer, keys = customers.resolve_customer(order)  # miss
+            self.assertEqual(1, lookup.call_count)
+            self.assertEqual((customer, keys),
+                             customers.resolve_customer(order))  # hit
+            self.assertEqual(1, lookup.call_count)
+            # the contact moved to another billing address
+            self.assertNotEqual(keys.bill_to, keys.ship_to)
+            jb.Contact.objects.filter(contact=keys.contact).update(
+                address=keys.ship_to)
+            moved = customers.resolve_customer(order)[1]
+            self.assertEqual((keys.contact, keys.bill_to),
+                             (moved.contact, moved.bill_to))
+            self.assertEqual(2, lookup.call_count)
+            self.assertEqual(keys.bill_to, jb.Contact.objects.get(
+                contact=keys.contact).address)
+            # the customer was modified in JobBOSS
+            jb.Customer.objects.filter(customer=keys.customer).update(
+                last_updated=datetime.datetime(2000, 1, 1))
+            customers.resolve_customer(order)
+            self.assertEqual(3, lookup.call_count)
+            customers.resolve_customer(order)
+            self.assertEqual(3, lookup.call_count)
+
+    def test_material_helpers(self):
+        from job import material_key, split_description
+        self.assertEqual(material_key('abc-1  '), material_key('ABC-1'))
+        self.assertEqual((None, None), split_description(None))
+        self.assertEqual(('short', None), split_description('short'))
+        self.assertEqual(('x' * 30, 'yy'), split_description('x' * 30 + 'yy'))
+
+    def test_assembly_index(self):
+        from assembly import AssemblyIndex
+        with open('core-python/tests/unit/mock_data/order.json') as data_file:
+            mock_order_json = json.load(data_file)
+        client = PaperlessClient()
+        client.get_resource = MagicMock(return_value=mock_order_json)
+        order = Order.get(1)
+        for order_item in order.order_items:
+            index = AssemblyIndex(order_item)
+            self.assertEqual(
+                sorted(c.id for c in order_item.components
+                       if not c.is_hardware),
+                sorted(a.component.id for a, _ in index.manufactured))
+            for comp, placements in index.hardware:
+                for parent_id, qty_per in placements:
+                    parent = order_item.get_component(parent_id)
+                    self.assertIn(qty_per, [c.quantity for c in parent.children
+                                            if c.child_id == comp.id] or [None])
+
+    def test_backlog(self):
+        import time
+        from types import SimpleNamespace
+        from backlog import Backlog
+        backlog = Backlog(max_attempts=2, backoff=0.01)
+        for number in (1, 2, 3):
+            backlog.add(SimpleNamespace(number=number))
+        self.assertEqual([1, 2], [o.number for o in backlog.take(2)])
+        backlog.done(1)
+        self.assertEqual('pending', backlog.failed(2, 'timeout'))
+        self.assertEqual([3], [o.number for o in backlog.take(5)])
+        self.assertEqual(1, backlog.recover())  # 3 was left in flight
+        time.sleep(0.02)
+        self.assertEqual([2, 3], sorted(o.number for o in backlog.take(5)))
+        self.assertEqual('failed', backlog.failed(2, 'timeout'))
+        backlog.add(SimpleNamespace(number=1))  # done
+        backlog.add(SimpleNamespace(number=2))  # failed
+        self.assertEqual({'done': 1, 'failed': 1, 'in_flight': 1},
+                         backlog.counts())
+        self.assertEqual(1, backlog.retry_failed())
+        # 3 is in flight, but JobBOSS already has a sales order for it
+        self.assertEqual(0, backlog.recover(lambda number: 42))
+        self.assertEqual(2, backlog.counts()['done'])
+
+    def test_report_package(self):
+        import tarfile
+        import tempfile
+        from report import ReportPackage
+        with tempfile.TemporaryDirectory() as tmp:
+            with ReportPackage(os.path.join(tmp, 'r')) as package:
+                with package.table('t.csv', ('A', 'B')) as table:
+                    table.writerow((1, 2))
+                with self.assertRaises(ValueError):
+                    with package.table('failed.csv') as table:
+                        raise ValueError
+            self.assertEqual({'rows': 1, 'bytes': 10, 'compressed_bytes': None},
+                             package.stats['t.csv'])
+            with tarfile.open(package.path) as archive:
+                self.assertEqual(['t.csv'], archive.getnames())
+                self.assertEqual(b'A,B\r\n1,2\r\n',
+                                 archive.extractfile('t.csv').read())
+
+    def test_snapshot(self):
+        import tempfile
+        import jobboss.models as jb
+        from snapshot import create_snapshot, compare_snapshots
+        with tempfile.TemporaryDirectory() as tmp:
+            before = os.path.join(tmp, 'before')
+            after = os.path.join(tmp, 'after')
+            create_snapshot(before, models=[jb.AutoNumber])
+            jb.AutoNumber.objects.create(
+                type='Snapshot', system_generated=True, last_nbr=1)
+            create_snapshot(after, models=[jb.AutoNumber])
+            changes = compare_snapshots(before, after)
+        table = jb.AutoNumber._meta.db_table
+        self.assertEqual({table: {'added': 1, 'deleted': 0, 'changed': 0}},
+                         changes)
 
     def test_routing(self):
         inside_name = 'Test Paperless Op'
@@ -0,0 +1,46 @@
+"""
+Wall-clock timing of the phases of an order import.
+"""
+import time
+import common
+
+logger = common.get_logger('timing')
+
+
+class PhaseTimer:
+    """Accumulates elapsed time per named phase. Phases may be entered many
+    times (e.g., once per component); their durations are summed."""
+
+    def __init__(self):
+        self.durations = {}  # phase name -> seconds, in first-seen order
+        self._started = time.perf_counter()
+        self._current = None
+        self._since = None
+
+    def switch(self, name):
+        """End the current phase, if any, and start timing the named one."""
+        now = time.perf_counter()
+        if self._current is not None:
+            self.durations[self._current] = \
+                self.durations.get(self._current, 0.) + now - self._since
+        self._current = name
+        self._since = now
+
+    @property
+    def current(self):
+        """Name of the phase being timed, or None."""
+        return self._current
+
+    def stop(self):
+        self.switch(None)
+
+    @property
+    def total(self):
+        return time.perf_counter() - self._started
+
+    def report(self, label):
+        self.stop()
+        phases = ', '.join('{} {:.3f}s'.format(name, seconds)
+                           for name, seconds in self.durations.items())
+        logger.info('%s timings: %s (total %.3fs)', label, phases,
+                    self.total)
@@ -0,0 +1,184 @@
+"""
+Imports the orders found in one connector run on a pool of writer threads.
+The thread running the Paperless SDK keeps fetching upcoming orders into a
+bounded queue while the writers run process_order, so API and database
+latency overlap. Django gives every thread its own database connection.
+Orders for the same customer are imported one after another, so creating that
+customer's contacts and addresses cannot race. With a Backlog, each order is
+stored there before it is queued, and the writers record the outcome of each
+import in it.
+"""
+from collections import deque
+import threading
+import time
+from django.db import connections
+import common
+from customers import customer_key
+from job import process_order
+
+logger = common.get_logger('workers')
+
+
+def order_weight(order):
+    """Rough measure of the memory an order occupies while queued."""
+    return sum(len(oi.components) for oi in order.order_items)
+
+
+class OrderQueue:
+    """FIFO of fetched orders, bounded both by number of orders and by their
+    total weight. put() blocks while the queue is full, applying backpressure
+    to the fetcher; one order is always accepted into an empty queue, however
+    large."""
+
+    def __init__(self, max_orders, max_weight):
+        self.max_orders = max_orders
+        self.max_weight = max_weight
+        self.high_water = 0
+        self._orders = deque()  # (customer, weight, order)
+        self._weight = 0
+        self._busy = set()  # customers with an order being imported
+        self._closed = False
+        self._cond = threading.Condition()
+
+    def _full(self, weight):
+        return self._orders and (
+            len(self._orders) >= self.max_orders or
+            self._weight + weight > self.max_weight)
+
+    def put(self, order):
+        weight = order_weight(order)
+        with self._cond:
+            while self._full(weight):
+                self._cond.wait()
+            self._orders.append((customer_key(order), weight, order))
+            self._weight += weight
+            self.high_water = max(self.high_water, len(self._orders))
+            self._cond.notify_all()
+
+    def take(self):
+        """Return the oldest order whose customer is not busy, waiting for
+        one if necessary, or None once the queue is closed and empty."""
+        with self._cond:
+            while True:
+                for entry in self._orders:
+                    customer, weight, order = entry
+                    if customer not in self._busy:
+                        self._orders.remove(entry)
+                        self._weight -= weight
+                        self._busy.add(customer)
+                        self._cond.notify_all()
+                        return order
+                if self._closed and not self._orders:
+                    return None
+                self._cond.wait()
+
+    def done(self, order):
+        with self._cond:
+            self._busy.discard(customer_key(order))
+            self._cond.notify_all()
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+
+class OrderPool:
+    def __init__(self, workers=1, prefetch=0, prefetch_max_components=2000,
+                 backlog=None, batch=10):
+        self.workers = workers
+        self.backlog = backlog
+        self.batch = batch
+        self.succeeded = []
+        self.failed = []
+        self._queue = None
+        self._threads = []
+        self._started = time.perf_counter()
+        if workers > 1 or prefetch > 0:
+            self._queue = OrderQueue(max(prefetch, 1), prefetch_max_components)
+            for i in range(workers):
+                t = threading.Thread(target=self._work,
+                                     name='order-{}'.format(i), daemon=True)
+                t.start()
+                self._threads.append(t)
+
+    def submit(self, order):
+        """Queue order for a writer thread, blocking while the queue is full.
+        Without writer threads, import it right away, re-raising any error
+        unless the order is held in the backlog to be retried."""
+        if self.backlog is None:
+            self._dispatch(order)
+        else:
+            self.backlog.add(order)
+            self.resume()
+
+    def resume(self):
+        """Queue the orders in the backlog that are due, batch at a time."""
+        if self.backlog is None:
+            return
+        while True:
+            orders = self.backlog.take(self.batch)
+            if not orders:
+                return
+            for order in orders:
+                self._dispatch(order)
+
+    def _dispatch(self, order):
+        if self._queue is None:
+            self._import(order, reraise=self.backlog is None)
+        else:
+            self._queue.put(order)
+
+    def _work(self):
+        try:
+            while True:
+                order = self._queue.take()
+                if order is None:
+                    return
+                try:
+                    self._import(order)
+                finally:
+                    self._queue.done(order)
+        finally:
+            connections.close_all()
+
+    def _import(self, order, reraise=False):
+        try:
+            process_order(order)
+        except Exception as e:
+            logger.exception('Could not import order %s', order.number)
+            self.failed.append(order.number)
+            if self.backlog is not None:
+                self.backlog.failed(order.number, e)
+            if reraise:
+                raise
+        else:
+            self.succeeded.append(order.number)
+            if self.backlog is not None:
+                self.backlog.done(order.number)
+
+    def join(self):
+        """Wait for all submitted orders and log a throughput summary."""
+        if self._queue is not None:
+            self._queue.close()
+            for t in self._threads:
+                t.join()
+        elapsed = time.perf_counter() - self._started
+        count = len(self.succeeded) + len(self.failed)
+        if count:
+            logger.info(
+                'Imported %d of %d orders with %d worker(s) in %.1fs '
+                '(%.1f orders/min)', len(self.succeeded), count,
+                self.workers, elapsed, count * 60 / elapsed)
+        if self._queue is not None and self._queue.high_water:
+            logger.info('Up to %d orders were waiting for a writer',
+                        self._queue.high_water)
+        if self.failed:
+            logger.error('Failed orders: %s',
+                         ', '.join(str(n) for n in self.failed))
+        if self.backlog is not None:
+            counts = self.backlog.counts()
+            if counts.get('pending') or counts.get('failed'):
+                logger.info('Backlog: %d orders waiting to be retried, %d '
+                            'failed', counts.get('pending', 0),
+                            counts.get('failed', 0))
@@ -0,0 +1,118 @@
+"""
+Routes JobBOSS row inserts made while importing an order. By default every
+row is inserted as soon as it is built. In bulk mode rows are buffered per
+model and written with one bulk_create per table when the order is flushed.
+A PlanWriter records the rows instead of writing them, in the order they
+would be written.
+
+Every row is written with a single INSERT. Rows are new, so the UPDATE that
+Model.save() tries first for rows with a key already assigned is skipped,
+and keys the database assigns come back from the INSERT itself (OUTPUT
+INSERTED on SQL Server, RETURNING elsewhere) rather than from reloading the
+row.
+"""
+import common
+import jobboss.models as jb
+
+logger = common.get_logger('writer')
+
+FLUSH_ORDER = (
+    jb.Attachment,
+    jb.Delivery,
+    jb.Job,
+    jb.BillOfJobs,
+    jb.MaterialReq,
+    jb.JobOperation,
+)
+"""Parents must be inserted before the rows that reference them."""
+
+
+class RowWriter:
+    def __init__(self, bulk=False):
+        self.bulk = bulk
+        self._pending = {}  # model class -> list of unsaved instances
+
+    def add(self, instance):
+        """Insert instance now, or queue it for the next flush in bulk
+        mode."""
+        if self.bulk:
+            self._pending.setdefault(type(instance), []).append(instance)
+        else:
+            self.insert(instance)
+
+    def insert(self, instance):
+        """Insert instance now, even in bulk mode, because later rows need it
+        to exist or need its database-assigned key, which is set on instance
+        from the value the INSERT returns. Returns instance."""
+        instance.save(force_insert=True)
+        return instance
+
+    def save_all(self, instances):
+        """Insert instances, all of one model, now with one bulk_create."""
+        if instances:
+            type(instances[0]).objects.bulk_create(instances)
+
+    @property
+    def pending_count(self):
+        return sum(len(rows) for rows in self._pending.values())
+
+    def _flush_models(self):
+        """Models with queued rows, in the order they are flushed."""
+        models = [m for m in FLUSH_ORDER if m in self._pending]
+        return models + [m for m in self._pending if m not in FLUSH_ORDER]
+
+    def flush(self):
+        """Insert all queued rows, one bulk_create per model."""
+        for model in self._flush_models():
+            rows = self._pending.pop(model)
+            try:
+                model.objects.bulk_create(rows)
+            except:
+                logger.error('Could not bulk insert %d %s rows', len(rows),
+                             model.__name__)
+                raise
+            logger.info('Bulk inserted %d %s rows', len(rows),
+                        model.__name__)
+
+
+class PlanWriter(RowWriter):
+    """Records, in order, the rows an import would write without writing
+    them. Rows whose key the database would assign get provisional negative
+    keys, so that rows referring to them can be matched up."""
+
+    def __init__(self, bulk=False):
+        super().__init__(bulk)
+        self.rows = []
+        self._provisional = 0
+
+    def add(self, instance):
+        if self.bulk:
+            self._pending.setdefault(type(instance), []).append(instance)
+        else:
+            self.rows.append(instance)
+
+    def insert(self, instance):
+        if instance.pk is None:
+            self._provisional -= 1
+            instance.pk = self._provisional
+        self.rows.append(instance)
+        return instance
+
+    def save_all(self, instances):
+        self.rows.extend(instances)
+
+    def flush(self):
+        for model in self._flush_models():
+            self.rows.extend(self._pending.pop(model))
+
+    def records(self):
+        """The recorded rows as {'model', 'table', 'fields'} dicts."""
+        return [
+            {
+                'model': type(row).__name__,
+                'table': row._meta.db_table,
+                'fields': {f.attname: getattr(row, f.attname)
+                           for f in row._meta.concrete_fields},
+            }
+            for row in self.rows
+        ]